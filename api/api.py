@@ -1,24 +1,62 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime, timedelta
-from io import BytesIO
 import os
 import secrets
 
 import ecdsa
 from ecdsa.keys import BadSignatureError
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, json, jsonify, request
 import jwt
 import lnurl
-import pyqrcode
+from sqlalchemy import case, tuple_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql.functions import func
 
 from extensions import db
+import events
 import models as m
-from main import app, get_lnd_client, get_s3, get_twitter
-from main import get_token_from_request, get_user_from_token, user_required
+from main import app, get_bid_payment_request, get_cache, get_twitter, invalidate_cache
+from main import get_token_from_request, get_user_from_token, replica_reads, user_required
+import qr
 
 api_blueprint = Blueprint('api', __name__)
 
+def paginate(query, sort_column, id_column):
+    """
+    Keyset pagination (newest first) for a query, using the limit and cursor request arguments.
+    Returns the items on the requested page and the cursor of the next page (None if this is the last page).
+    """
+    try:
+        limit = int(request.args.get('limit', app.config['DEFAULT_PAGE_LIMIT']))
+    except ValueError:
+        raise m.ValidationError("Invalid limit.")
+    if not 0 < limit <= app.config['MAX_PAGE_LIMIT']:
+        raise m.ValidationError(f"Limit must be between 1 and {app.config['MAX_PAGE_LIMIT']}.")
+
+    if request.args.get('cursor'):
+        try:
+            sort_value, id = urlsafe_b64decode(request.args['cursor']).decode('ascii').split(",")
+            sort_value, id = datetime.fromisoformat(sort_value), int(id)
+        except ValueError: # NB: this includes base64 and unicode decoding errors
+            raise m.ValidationError("Invalid cursor.")
+        # NB: (sort_column, id) < (sort_value, id) is a row value comparison that Postgres can answer using an index on both columns
+        query = query.filter(tuple_(sort_column, id_column) < tuple_(sort_value, id))
+
+    # we get one extra row just to find out whether there is a next page
+    items = query.order_by(sort_column.desc(), id_column.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = urlsafe_b64encode(f"{getattr(last, sort_column.key).isoformat()},{getattr(last, id_column.key)}".encode('ascii')).decode('ascii')
+    return items, next_cursor
+
+def get_qr_format():
+    # NB: clients that can draw the QR code themselves can ask for the (much smaller) matrix instead of the SVG
+    qr_format = request.args.get('qr_format')
+    return qr_format if qr_format in qr.FORMATS else qr.SVG
+
 @api_blueprint.route('/api/healthcheck', methods=['GET'])
 def healthcheck(): # TODO: I don't really like this, for some reason, but it is used in "dev" mode by docker-compose
     return jsonify({'success': True})
@@ -39,10 +77,8 @@ def login():
 
         url = app.config['BASE_URL'] + f"/api/login?tag=login&k1={k1}"
         ln_url = lnurl.encode(url).bech32
-        qr = BytesIO()
-        pyqrcode.create(ln_url).svg(qr, omithw=True, scale=4)
 
-        return jsonify({'k1': k1, 'lnurl': str(ln_url), 'qr': qr.getvalue().decode('utf-8')})
+        return jsonify({'k1': k1, 'lnurl': str(ln_url), 'qr': qr.render(str(ln_url), get_qr_format(), cache=False)})
 
     lnauth = m.LnAuth.query.filter_by(k1=request.args['k1']).first()
 
@@ -90,11 +126,12 @@ def login():
     db.session.delete(lnauth)
     db.session.commit()
 
-    token = jwt.encode({'user_key': user.key, 'exp': datetime.utcnow() + timedelta(hours=24)}, app.config['SECRET_KEY'], "HS256")
+    token = jwt.encode({'user_id': user.id, 'user_key': user.key, 'exp': datetime.utcnow() + timedelta(hours=24)}, app.config['SECRET_KEY'], "HS256")
 
     return jsonify({'success': True, 'token': token, 'user': user.to_dict()})
 
 @api_blueprint.route('/api/users/me', methods=['GET', 'POST']) # TODO: POST here should actually be PUT
+@replica_reads
 @user_required
 def me(user):
     if request.method == 'GET':
@@ -109,26 +146,32 @@ def me(user):
             if not clean_username:
                 return jsonify({'message': "Invalid Twitter username!"}), 400
             if clean_username != user.twitter_username:
-                user.twitter_username = clean_username
-
                 twitter = get_twitter()
 
+                # the user might have just changed their username on Twitter, so don't trust anything we cached about either username
+                if user.twitter_username:
+                    twitter.invalidate_user(user.twitter_username)
+                twitter.invalidate_user(clean_username)
+
+                user.twitter_username = clean_username
+
                 twitter_user = twitter.get_user(user.twitter_username)
                 if not twitter_user:
                     return jsonify({'message': "Twitter profile not found!"}), 400
 
-                user.twitter_profile_image_url = twitter_user['profile_image_url']
-                if not user.fetch_twitter_profile_image(get_s3()):
-                    return jsonify({'message': "Error fetching profile picture!"}), 400
+                user.twitter_user_id = twitter_user['id']
+                user.set_twitter_profile_image(twitter_user['profile_image_url'])
 
                 user.twitter_username_verified = False
 
-                plebeian_twitter_user = twitter.get_user(app.config['TWITTER_USER'])
+                # NB: the verification tweet was probably pinned just now, so we can't use the cached user here
+                plebeian_twitter_user = twitter.fetch_user(app.config['TWITTER_USER'])
 
                 user.twitter_username_verification_tweet_id = plebeian_twitter_user['pinned_tweet_id']
 
         if 'contribution_percent' in request.json:
             user.contribution_percent = request.json['contribution_percent']
+        invalidate_cache(m.User.get_cache_key(user.key))
         try:
             db.session.commit()
         except IntegrityError:
@@ -143,10 +186,12 @@ def verify_twitter(user):
         return jsonify({'message': "Please like the tweet to verify your username."}), 400
     else:
         user.twitter_username_verified = True
+        invalidate_cache(m.User.get_cache_key(user.key))
         db.session.commit()
         return jsonify({})
 
 @api_blueprint.route('/api/users/me/notifications', methods=['GET', 'PUT'])
+@replica_reads
 @user_required
 def user_notifications(user):
     existing_notifications = {
@@ -173,6 +218,7 @@ def user_notifications(user):
         return jsonify({})
 
 @api_blueprint.route('/api/users/me/messages', methods=['GET'])
+@replica_reads
 @user_required
 def messages(user):
     # by default we only return INTERNAL messages (to be shown in the UI),
@@ -180,19 +226,27 @@ def messages(user):
     # for example via=TWITTER_DM will return all messages sent to this user via TWITTER_DM
     via = request.args.get('via') or 'INTERNAL'
 
-    if via == 'all':
-        messages = user.messages
-    else:
-        messages = m.Message.query.filter_by(user_id=user.id, notified_via=via).all()
+    messages = m.Message.query.filter_by(user_id=user.id)
+    if via != 'all':
+        messages = messages.filter_by(notified_via=via)
 
-    return jsonify({'messages': [m.to_dict() for m in messages]})
+    try:
+        messages, next_cursor = paginate(messages, m.Message.created_at, m.Message.id)
+    except m.ValidationError as e:
+        return jsonify({'message': e.message}), 400
+
+    return jsonify({'messages': [m.to_dict() for m in messages], 'next_cursor': next_cursor})
 
 @api_blueprint.route('/api/auctions', methods=['GET', 'POST'])
+@replica_reads
 @user_required
 def auctions(user):
     if request.method == 'GET':
-        auctions = [a.to_dict(for_user=user.id) for a in user.auctions]
-        return jsonify({'auctions': auctions})
+        try:
+            auctions, next_cursor = paginate(m.Auction.query_with_related().filter_by(seller_id=user.id), m.Auction.created_at, m.Auction.id)
+        except m.ValidationError as e:
+            return jsonify({'message': e.message}), 400
+        return jsonify({'auctions': m.Auction.to_dict_list(auctions, for_user=user.id), 'next_cursor': next_cursor})
     else:
         for k in ['title', 'description', 'duration_hours', 'starting_bid', 'reserve_bid']:
             if k not in request.json:
@@ -207,6 +261,9 @@ def auctions(user):
         key = m.Auction.generate_key(auction_count)
         auction = m.Auction(seller=user, key=key, **validated)
         db.session.add(auction)
+        if auction.end_date:
+            m.NotificationEvent.enqueue(m.NotificationEvent.END_DATE_CHANGED, auction)
+        invalidate_cache(m.Auction.FEATURED_CACHE_KEY)
         db.session.commit()
 
         # follow your own path (once you know the ID)!
@@ -218,41 +275,44 @@ def auctions(user):
 
 @api_blueprint.route('/api/auctions/featured', methods=['GET'])
 def featured_auctions():
-    auctions = m.Auction.query.filter(
-        (m.Auction.is_featured == True)
-        | ((m.Auction.is_featured == None)
-         & (m.Auction.start_date <= datetime.utcnow())
-         & (m.Auction.end_date >= datetime.utcnow()))
-    ).all()
-    return jsonify({'auctions': [a.to_dict() for a in sorted(auctions, key=lambda a: len(a.bids), reverse=True)]})
+    # NB: no @replica_reads here, since the database is only read in order to fill the (shared) cache
+    cache = get_cache()
+    featured = cache.get(m.Auction.FEATURED_CACHE_KEY)
+    if featured is None:
+        now = datetime.utcnow()
+        auctions = m.Auction.query_with_related().filter(
+            (m.Auction.is_featured == True)
+            | ((m.Auction.is_featured == None)
+             & (m.Auction.start_date <= now)
+             & (m.Auction.end_date >= now))
+        ).all()
+        featured = json.dumps({'auctions': m.Auction.to_dict_list(sorted(auctions, key=lambda a: a.settled_bid_count, reverse=True))})
+
+        # changes to auctions are invalidating the cache explicitly,
+        # but auctions starting or ending also change the response, so we should not cache it past the next such event
+        ttl = app.config['FEATURED_AUCTIONS_CACHE_TTL']
+        next_start, next_end = db.session.query(
+            func.min(case((m.Auction.start_date > now, m.Auction.start_date))),
+            func.min(case((m.Auction.end_date > now, m.Auction.end_date)))
+        ).filter(m.Auction.is_featured.isnot(False)).one()
+        for next_change in [next_start, next_end]:
+            if next_change is not None:
+                ttl = min(ttl, (next_change - now).total_seconds())
+        cache.set(m.Auction.FEATURED_CACHE_KEY, featured, ttl)
+
+    return app.response_class(featured, mimetype='application/json')
 
 @api_blueprint.route('/api/auctions/<string:key>', methods=['GET', 'PUT', 'DELETE'])
+@replica_reads
 def auction(key):
     user = get_user_from_token(get_token_from_request())
-    auction = m.Auction.query.filter_by(key=key).first()
+    auction = (m.Auction.query_with_related() if request.method == 'GET' else m.Auction.query).filter_by(key=key).first()
     if not auction:
         return jsonify({'message': "Not found."}), 404
 
     if request.method == 'GET':
-        if auction.ended:
-            if auction.winning_bid_id is None and auction.contribution_payment_request is None:
-                # auction ended, but no winning bid has been picked
-                # => ask the user with the top bid to send the contribution
-                if auction.reserve_bid_reached:
-                    top_bid = auction.get_top_bid()
-                    auction.contribution_amount = int(auction.seller.contribution_percent / 100 * top_bid.amount)
-                    if auction.contribution_amount < app.config['MINIMUM_CONTRIBUTION_AMOUNT']:
-                        auction.contribution_amount = 0 # probably not worth the fees, at least in the next few years
-
-                        # settle the contribution and pick the winner right away
-                        auction.contribution_requested_at = auction.contribution_settled_at = datetime.utcnow()
-                        auction.winning_bid_id = top_bid.id
-                    else:
-                        response = get_lnd_client().add_invoice(value=auction.contribution_amount, expiry=app.config['LND_CONTRIBUTION_INVOICE_EXPIRY'])
-                        auction.contribution_payment_request = response.payment_request
-                        auction.contribution_requested_at = datetime.utcnow()
-                    db.session.commit()
-        return jsonify({'auction': auction.to_dict(for_user=(user.id if user else None))})
+        # NB: this must not change anything! Once the auction ends, finalize-auctions takes care of the contribution and the winner.
+        return jsonify({'auction': auction.to_dict(for_user=(user.id if user else None), qr_format=get_qr_format())})
     else:
         is_changing_featured_state = request.method == 'PUT' and 'is_featured' in set(request.json.keys())
         is_changing_featured_state_only = request.method == 'PUT' and set(request.json.keys()) == {'is_featured'}
@@ -279,12 +339,17 @@ def auction(key):
             for k, v in validated.items():
                 setattr(auction, k, v)
 
+            if 'end_date' in validated:
+                m.NotificationEvent.enqueue(m.NotificationEvent.END_DATE_CHANGED, auction)
+
+            invalidate_cache(m.Auction.FEATURED_CACHE_KEY)
             db.session.commit()
 
             return jsonify({})
         elif request.method == 'DELETE':
             # TODO: should we allow deletion of a started auction?
             db.session.delete(auction)
+            invalidate_cache(m.Auction.FEATURED_CACHE_KEY)
             db.session.commit()
 
             return jsonify({})
@@ -325,9 +390,8 @@ def start_twitter(user, key):
     if not twitter_user:
         return jsonify({'message': "Twitter profile not found!"}), 400
 
-    user.twitter_profile_image_url = twitter_user['profile_image_url']
-    if not user.fetch_twitter_profile_image(get_s3()):
-        return jsonify({'message': "Error fetching profile picture!"}), 500
+    user.twitter_user_id = twitter_user['id']
+    user.set_twitter_profile_image(twitter_user['profile_image_url'])
 
     tweets = twitter.get_auction_tweets(twitter_user['id'])
     tweet = None
@@ -344,23 +408,39 @@ def start_twitter(user, key):
         return jsonify({'message': "Tweet does not have any attached pictures."}), 400
 
     user.twitter_username_verified = True
+    invalidate_cache(m.User.get_cache_key(user.key))
     auction.twitter_id = tweet['id']
     auction.start_date = datetime.utcnow()
     auction.end_date = auction.start_date + timedelta(hours=auction.duration_hours)
+    m.NotificationEvent.enqueue(m.NotificationEvent.END_DATE_CHANGED, auction)
 
     m.Media.query.filter_by(auction_id=auction.id).delete()
 
-    s3 = get_s3()
-    for i, photo in enumerate(tweet['photos'], 1):
-        media = m.Media(auction_id=auction.id, twitter_media_key=photo['media_key'], url=photo['url'])
-        if not media.fetch(s3, f"auction_{auction.key}_media_{i}"):
-            return jsonify({'message': "Error fetching picture!"}), 400
-        db.session.add(media)
+    # NB: the pictures are fetched (and uploaded to S3) in the background, by ingest-media
+    for photo in tweet['photos']:
+        db.session.add(m.Media(auction_id=auction.id, twitter_media_key=photo['media_key'], url=photo['url']))
+    events.notify(events.MEDIA_EVENTS)
 
+    invalidate_cache(m.Auction.FEATURED_CACHE_KEY)
     db.session.commit()
 
     return jsonify({})
 
+@api_blueprint.route('/api/auctions/<string:key>/bids', methods=['GET'])
+@replica_reads
+def get_bids(key):
+    user = get_user_from_token(get_token_from_request())
+    auction = m.Auction.query.filter_by(key=key).first()
+    if not auction:
+        return jsonify({'message': "Not found."}), 404
+
+    try:
+        bids, next_cursor = paginate(m.Bid.query.options(joinedload(m.Bid.buyer)).filter(m.Bid.auction_id == auction.id, m.Bid.settled_at != None), m.Bid.requested_at, m.Bid.id)
+    except m.ValidationError as e:
+        return jsonify({'message': e.message}), 400
+
+    return jsonify({'bids': [bid.to_dict(for_user=(user.id if user else None)) for bid in bids], 'next_cursor': next_cursor})
+
 @api_blueprint.route('/api/auctions/<string:key>/bids', methods=['POST'])
 @user_required
 def bids(user, key):
@@ -368,23 +448,25 @@ def bids(user, key):
     if not auction:
         return jsonify({'message': "Not found."}), 404
 
-    if not auction.started or auction.ended:
-        return jsonify({'message': "Auction not running."}), 403
+    if 'amount' not in request.json:
+        return jsonify({'message': "Missing key: amount."}), 400
+    try:
+        amount = int(request.json['amount'])
+    except (TypeError, ValueError):
+        return jsonify({'message': "Invalid amount."}), 400
 
-    amount = int(request.json['amount'])
+    try:
+        auction.validate_bid(amount)
+    except m.AuctionNotRunning as e:
+        return jsonify({'message': e.message}), 403
+    except m.ValidationError as e:
+        return jsonify({'message': e.message}), 400
 
-    top_bid = auction.get_top_bid()
-    if top_bid and amount <= top_bid.amount:
-        return jsonify({'message': f"The top bid is currently {top_bid.amount}. Your bid needs to be higher!"}), 400
-    elif amount <= auction.starting_bid:
-        return jsonify({'message': f"Your bid needs to be higher than {auction.starting_bid}, the starting bid."}), 400
-
-    response = get_lnd_client().add_invoice(value=app.config['LND_BID_INVOICE_AMOUNT'], expiry=app.config['LND_BID_INVOICE_EXPIRY'])
-
-    payment_request = response.payment_request
+    payment_request = get_bid_payment_request()
 
     bid = m.Bid(auction=auction, buyer=user, amount=amount, payment_request=payment_request)
     db.session.add(bid)
+    events.notify(events.PAYMENT_REQUESTS, payment_request)
 
     started_following = False
     user_auction = m.UserAuction.query.filter_by(user_id=user.id, auction_id=auction.id).one_or_none()
@@ -398,12 +480,9 @@ def bids(user, key):
             user_auction.following = True
     db.session.commit()
 
-    qr = BytesIO()
-    pyqrcode.create(payment_request).svg(qr, omithw=True, scale=4)
-
     return jsonify({
         'payment_request': payment_request,
-        'qr': qr.getvalue().decode('utf-8'),
+        'qr': qr.render(payment_request, get_qr_format()),
         'messages': [
             "Your bid will be confirmed once you scan the QR code.",
         ] + (["You are now following this auction."] if started_following else []),
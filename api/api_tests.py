@@ -1,12 +1,23 @@
+import calendar
 from datetime import datetime, timedelta
+import os
+import random
+import subprocess
+import tempfile
 import time
 
 import dateutil.parser
 import ecdsa
+from flask import Flask, g
+import jwt
+import lndgrpc.common
 import unittest
 import requests
 
-from main import app
+from extensions import db, REPLICA_BIND, RoutingSQLAlchemy
+from main import app, finalize_auction, get_bid_invoice_expiry, get_bid_payment_request, load_pending_payment_requests, MockLNDClient, primary_reads, process_invoices, settle_invoices
+import events
+import models as m
 
 class TestApi(unittest.TestCase):
     def do(self, f, path, params=None, json=None, headers=None):
@@ -128,9 +139,14 @@ class TestApi(unittest.TestCase):
         self.assertEqual(code, 200)
 
         # check user details again
-        code, response = self.get("/api/users/me",
-            headers=self.get_auth_headers(token_1))
-        self.assertEqual(code, 200)
+        # (the profile picture is fetched in the background...)
+        for _ in range(10):
+            code, response = self.get("/api/users/me",
+                headers=self.get_auth_headers(token_1))
+            self.assertEqual(code, 200)
+            if "/mock-s3-files/" in response['user']['twitter_profile_image_url']:
+                break
+            time.sleep(1)
         self.assertEqual(response['user']['twitter_username'], 'mock_username')
         self.assertFalse(response['user']['twitter_username_verified'])
         self.assertTrue("twitter.com" in response['user']['twitter_username_verification_tweet'])
@@ -284,6 +300,12 @@ class TestApi(unittest.TestCase):
         self.assertEqual(response['auctions'][0]['key'], auction_key)
         self.assertEqual(response['auctions'][0]['started'], False)
         self.assertEqual(response['auctions'][0]['ended'], False)
+        self.assertIsNone(response['next_cursor'])
+
+        # can't list auctions with an invalid cursor
+        code, response = self.get("/api/auctions", {'cursor': "invalid"},
+            headers=self.get_auth_headers(token_1))
+        self.assertEqual(code, 400)
 
         # GET the newly created auction by key (even unauthenticated!)
         code, response = self.get(f"/api/auctions/{auction_key}")
@@ -458,6 +480,13 @@ class TestApi(unittest.TestCase):
         self.assertEqual(len(response['auction']['bids']), 1)
         self.assertEqual(response['auction']['bids'][0]['payment_request'], bid_payment_request)
 
+        # the settled bid can also be listed separately
+        code, response = self.get(f"/api/auctions/{auction_key}/bids", {'limit': 1})
+        self.assertEqual(code, 200)
+        self.assertEqual(len(response['bids']), 1)
+        self.assertEqual(response['bids'][0]['amount'], 888)
+        self.assertIsNone(response['next_cursor'])
+
         # can't place a bid lower than the previous one now
         code, response = self.post(f"/api/auctions/{auction_key}/bids", {'amount': 777},
             headers=self.get_auth_headers(token_2))
@@ -505,7 +534,16 @@ class TestApi(unittest.TestCase):
         self.assertEqual(response['auction']['ended'], False)
         self.assertEqual(dateutil.parser.isoparse(response['auction']['start_date']) + timedelta(hours=24), dateutil.parser.isoparse(response['auction']['end_date']))
         self.assertEqual(len(response['auction']['media']), 4)
-        self.assertTrue("/mock-s3-files/" in response['auction']['media'][0]['url'])
+
+        # the pictures are fetched in the background...
+        for _ in range(10):
+            code, response = self.get(f"/api/auctions/{auction_key_3}",
+                headers=self.get_auth_headers(token_2))
+            self.assertEqual(code, 200)
+            if all("/mock-s3-files/" in media['url'] for media in response['auction']['media']):
+                break
+            time.sleep(1)
+        self.assertTrue(all("/mock-s3-files/" in media['url'] for media in response['auction']['media']))
 
         # now the auction is "featured"
         code, response = self.get("/api/auctions/featured")
@@ -552,4 +590,352 @@ class TestApi(unittest.TestCase):
         self.assertTrue('auction' in response)
         cleaned_description = response['auction']['description']
         expected_cleaned_description = """&lt;script type="text/javascript"&gt;alert("malicious")&lt;/script&gt;"""
-        self.assertEqual(cleaned_description, expected_cleaned_description)
\ No newline at end of file
+        self.assertEqual(cleaned_description, expected_cleaned_description)
+
+class TestReplicaReads(unittest.TestCase):
+    def test_routing(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # NB: two SQLite databases stand in for the primary and the replica
+            test_app = Flask(__name__)
+            test_app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_dir}/primary.db"
+            test_app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: f"sqlite:///{tmp_dir}/replica.db"}
+            test_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+            test_db = RoutingSQLAlchemy(test_app)
+
+            class Thing(test_db.Model):
+                id = test_db.Column(test_db.Integer, primary_key=True)
+                name = test_db.Column(test_db.String(32), nullable=False)
+
+            with test_app.app_context():
+                for bind in [None, REPLICA_BIND]:
+                    engine = test_db.get_engine(test_app, bind=bind)
+                    Thing.__table__.create(engine)
+                    with engine.begin() as connection:
+                        connection.execute(Thing.__table__.insert().values(name=bind or 'primary'))
+
+            with test_app.test_request_context():
+                # reads go to the primary by default...
+                self.assertEqual([t.name for t in Thing.query.all()], ['primary'])
+                test_db.session.remove()
+
+            with test_app.test_request_context():
+                # ... and to the replica if the endpoint allows it
+                g.use_replica = True
+                self.assertEqual([t.name for t in Thing.query.all()], [REPLICA_BIND])
+
+                # but not when filling a shared cache
+                with primary_reads():
+                    self.assertEqual([t.name for t in Thing.query.populate_existing().all()], ['primary'])
+
+                # writes always go to the primary
+                test_db.session.add(Thing(name='new'))
+                test_db.session.commit()
+                test_db.session.remove()
+
+            with test_app.test_request_context():
+                self.assertEqual(sorted(t.name for t in Thing.query.all()), ['new', 'primary'])
+                test_db.session.remove()
+
+class TestSettleBids(unittest.TestCase):
+    """
+    These work directly with the database, in a transaction that is rolled back at the end,
+    so the other services (like the settle-bids worker, which settles all the bids it sees in "mock" mode) don't get to see our data.
+    """
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.app_context.pop()
+
+    def create_bid(self, amount=1000, requested_at=None, auction=None):
+        if auction is None:
+            seller = m.User(key=f"TEST_SELLER_{random.randint(0, 10 ** 9)}")
+            auction = m.Auction(seller=seller, key=m.Auction.generate_key(m.Auction.query.count()), title="Test", description="Test",
+                start_date=datetime.utcnow() - timedelta(hours=1), duration_hours=24, end_date=datetime.utcnow() + timedelta(hours=23),
+                starting_bid=0, reserve_bid=0)
+        buyer = m.User(key=f"TEST_BUYER_{random.randint(0, 10 ** 9)}")
+        bid = m.Bid(auction=auction, buyer=buyer, amount=amount, payment_request=f"TEST_{random.randint(0, 10 ** 9)}", requested_at=requested_at or datetime.utcnow())
+        db.session.add(bid)
+        db.session.flush()
+        return bid
+
+    def get_invoice(self, bid, settle_index, paid_at=None):
+        # NB: unless told otherwise, the invoice was paid right after the bid was placed
+        settle_date = calendar.timegm((paid_at or bid.requested_at).utctimetuple())
+        return MockLNDClient.InvoiceResponse(bid.payment_request, lndgrpc.common.ln.Invoice.SETTLED, settle_index, settle_date)
+
+    def test_settle_invoices(self):
+        bid_1 = self.create_bid(amount=1000)
+        bid_2 = self.create_bid(amount=2000, auction=bid_1.auction)
+        other_auction_bid = self.create_bid(amount=500)
+
+        self.assertEqual(settle_invoices([self.get_invoice(bid_1, 1), self.get_invoice(bid_2, 2), self.get_invoice(other_auction_bid, 3)]), 3)
+        self.assertIsNotNone(bid_1.settled_at)
+        self.assertIsNotNone(bid_2.settled_at)
+        self.assertEqual(bid_1.auction.top_bid_id, bid_2.id)
+        self.assertEqual(bid_1.auction.settled_bid_count, 2)
+        self.assertEqual(other_auction_bid.auction.top_bid_id, other_auction_bid.id)
+
+        # getting the same invoice again (after a restart, for example) doesn't change anything
+        self.assertEqual(settle_invoices([self.get_invoice(bid_1, 1)]), 0)
+        self.assertEqual(bid_1.auction.settled_bid_count, 2)
+
+    def test_settle_late_invoices(self):
+        bid = self.create_bid(requested_at=datetime.utcnow() - get_bid_invoice_expiry() * 2)
+        # LND wouldn't accept this payment anymore, but in case it did, it doesn't mean one can place a bid that was requested long ago
+        self.assertEqual(settle_invoices([self.get_invoice(bid, 1, paid_at=datetime.utcnow())]), 0)
+        self.assertIsNone(bid.settled_at)
+        self.assertIsNotNone(bid.rejected_at)
+        self.assertIsNone(bid.auction.top_bid_id)
+
+        ended_auction_bid = self.create_bid()
+        ended_auction_bid.auction.end_date = datetime.utcnow() - timedelta(seconds=10)
+        end_date = ended_auction_bid.auction.end_date
+        # ... nor can a bid be placed (and the auction extended) after the auction ended
+        self.assertEqual(settle_invoices([self.get_invoice(ended_auction_bid, 2, paid_at=datetime.utcnow())]), 0)
+        self.assertIsNone(ended_auction_bid.settled_at)
+        self.assertIsNotNone(ended_auction_bid.rejected_at)
+        self.assertEqual(ended_auction_bid.auction.end_date, end_date)
+
+        # the buyers were charged after all, so they are told that the deposit will be refunded
+        messages = m.Message.query.filter(m.Message.user_id.in_([bid.buyer_id, ended_auction_bid.buyer_id])).all()
+        self.assertEqual(sorted(message.key for message in messages), sorted([f"BID_REJECTED_{bid.id}", f"BID_REJECTED_{ended_auction_bid.id}"]))
+
+        # and a rejected bid is not waited for anymore, so replaying the invoice doesn't change anything
+        self.assertNotIn(bid.payment_request, set(load_pending_payment_requests()))
+        self.assertEqual(settle_invoices([self.get_invoice(bid, 1, paid_at=datetime.utcnow())]), 0)
+
+    def test_bid_stats_query(self):
+        bid_1 = self.create_bid(amount=1000)
+        bid_2 = self.create_bid(amount=2000, auction=bid_1.auction)
+        tied_bid = self.create_bid(amount=2000, auction=bid_1.auction)
+        self.create_bid(amount=3000, auction=bid_1.auction) # never settled
+        settle_invoices([self.get_invoice(bid_1, 1), self.get_invoice(bid_2, 2), self.get_invoice(tied_bid, 3)])
+
+        # the stats computed from scratch match the ones kept up to date by settle-bids
+        bid_stats = m.Auction.bid_stats_query()
+        stats = db.session.query(bid_stats).filter(bid_stats.c.auction_id == bid_1.auction_id).one()
+        self.assertEqual((stats.top_bid_id, stats.top_bid_amount, stats.settled_bid_count), (bid_2.id, 2000, 3))
+        self.assertEqual((bid_1.auction.top_bid_id, bid_1.auction.top_bid_amount, bid_1.auction.settled_bid_count), (bid_2.id, 2000, 3))
+
+    def end_auction(self, auction, contribution_percent):
+        auction.seller.contribution_percent = contribution_percent
+        auction.end_date = datetime.utcnow() - timedelta(seconds=app.config['FINALIZE_AUCTIONS_DELAY'] + 1)
+        db.session.flush()
+
+    def test_finalize_auction(self):
+        bid_1 = self.create_bid(amount=1000)
+        bid_2 = self.create_bid(amount=2000, auction=bid_1.auction)
+        settle_invoices([self.get_invoice(bid_1, 1), self.get_invoice(bid_2, 2)])
+        auction = bid_1.auction
+        self.end_auction(auction, contribution_percent=10)
+
+        # the contribution is requested from the top bidder...
+        finalize_auction(auction)
+        self.assertEqual(auction.contribution_amount, 200)
+        self.assertIsNotNone(auction.contribution_requested_at)
+        self.assertIsNotNone(auction.contribution_payment_request)
+        self.assertIn(auction.contribution_payment_request, set(load_pending_payment_requests()))
+        self.assertIsNone(auction.winning_bid_id)
+
+        # ... who wins the auction once it is paid
+        contribution_invoice = MockLNDClient.InvoiceResponse(auction.contribution_payment_request, lndgrpc.common.ln.Invoice.SETTLED, 3)
+        self.assertEqual(settle_invoices([contribution_invoice]), 1)
+        self.assertIsNotNone(auction.contribution_settled_at)
+        self.assertEqual(auction.winning_bid_id, bid_2.id)
+
+        # getting the same invoice again doesn't change anything
+        self.assertEqual(settle_invoices([contribution_invoice]), 0)
+
+    def test_finalize_auction_small_contribution(self):
+        bid = self.create_bid(amount=1000)
+        settle_invoices([self.get_invoice(bid, 1)])
+        auction = bid.auction
+        self.end_auction(auction, contribution_percent=1)
+
+        # a contribution this small is not worth the fees, so we have a winner right away
+        finalize_auction(auction)
+        self.assertEqual(auction.contribution_amount, 0)
+        self.assertIsNone(auction.contribution_payment_request)
+        self.assertIsNotNone(auction.contribution_settled_at)
+        self.assertEqual(auction.winning_bid_id, bid.id)
+
+    def test_settle_after_finalize(self):
+        bid_1 = self.create_bid(amount=1000)
+        settle_invoices([self.get_invoice(bid_1, 1)])
+        auction = bid_1.auction
+        # this one was paid right before the end, but settle-bids only got to it after the auction was finalized
+        bid_2 = self.create_bid(amount=2000, auction=auction, requested_at=datetime.utcnow() - timedelta(seconds=app.config['FINALIZE_AUCTIONS_DELAY'] + 5))
+        self.end_auction(auction, contribution_percent=10)
+        end_date = auction.end_date
+        finalize_auction(auction)
+
+        self.assertEqual(settle_invoices([self.get_invoice(bid_2, 2)]), 0)
+        self.assertIsNotNone(bid_2.rejected_at)
+        self.assertEqual(auction.top_bid_id, bid_1.id)
+        self.assertEqual(auction.end_date, end_date)
+
+        # so the contribution that was requested from the top bidder still makes them the winner
+        settle_invoices([MockLNDClient.InvoiceResponse(auction.contribution_payment_request, lndgrpc.common.ln.Invoice.SETTLED, 3)])
+        self.assertEqual(auction.winning_bid_id, bid_1.id)
+
+    def test_pending_payment_requests(self):
+        recent_bid = self.create_bid()
+        # the invoice of this one has expired by now, but it might have been paid before that
+        old_bid = self.create_bid(requested_at=datetime.utcnow() - timedelta(seconds=app.config['LND_BID_INVOICE_EXPIRY'] * 10))
+        settled_bid = self.create_bid()
+        settle_invoices([self.get_invoice(settled_bid, 1)])
+
+        db.session.query(m.State).filter_by(key=m.State.LAST_SETTLE_DATE).delete()
+        pending_payment_requests = set(load_pending_payment_requests())
+        self.assertIn(recent_bid.payment_request, pending_payment_requests)
+        self.assertIn(old_bid.payment_request, pending_payment_requests)
+        self.assertNotIn(settled_bid.payment_request, pending_payment_requests)
+
+        # once we know when the last invoice we processed was settled, we can leave out the ones that expired before that
+        db.session.add(m.State(key=m.State.LAST_SETTLE_DATE, value=str(int(time.time()))))
+        pending_payment_requests = set(load_pending_payment_requests())
+        self.assertIn(recent_bid.payment_request, pending_payment_requests)
+        self.assertNotIn(old_bid.payment_request, pending_payment_requests)
+
+    def test_replay(self):
+        settled_bid = self.create_bid()
+        last_settle_index, _, settled_count = process_invoices([self.get_invoice(settled_bid, 100)], 99, set(load_pending_payment_requests()))
+        self.assertEqual((last_settle_index, settled_count), (100, 1))
+
+        # after a restart, LND sends us the invoices since the checkpoint again, including one we already processed,
+        # one that isn't ours and one for a bid whose invoice expired by now (but which was paid in time)
+        old_bid = self.create_bid(requested_at=datetime.utcnow() - timedelta(seconds=app.config['LND_BID_INVOICE_EXPIRY'] * 10))
+        db.session.query(m.State).filter_by(key=m.State.LAST_SETTLE_DATE).delete() # the checkpoint we restart from was written before old_bid was paid
+        not_ours = MockLNDClient.InvoiceResponse("NOT_OURS", lndgrpc.common.ln.Invoice.SETTLED, 101)
+        invoices = [self.get_invoice(settled_bid, 100), not_ours, self.get_invoice(old_bid, 102)]
+        last_settle_index, our_invoices, settled_count = process_invoices(invoices, 99, set(load_pending_payment_requests()))
+        self.assertEqual((last_settle_index, settled_count), (102, 1))
+        self.assertEqual([i.payment_request for i in our_invoices], [old_bid.payment_request])
+        self.assertIsNotNone(old_bid.settled_at)
+        self.assertEqual(settled_bid.auction.settled_bid_count, 1)
+        self.assertEqual(old_bid.auction.settled_bid_count, 1)
+
+    def test_claim_deposit_invoice(self):
+        m.DepositInvoice.query.delete()
+        expiry = timedelta(seconds=app.config['LND_BID_INVOICE_EXPIRY'])
+        # this one would expire before the bid invoice is supposed to, so it can't be used anymore
+        expiring = m.DepositInvoice(payment_request="TEST_EXPIRING", expires_at=datetime.utcnow() + timedelta(seconds=60))
+        valid = m.DepositInvoice(payment_request="TEST_VALID", expires_at=datetime.utcnow() + expiry + timedelta(seconds=60))
+        valid_later = m.DepositInvoice(payment_request="TEST_VALID_LATER", expires_at=datetime.utcnow() + expiry + timedelta(hours=1))
+        db.session.add_all([expiring, valid, valid_later])
+        db.session.flush()
+
+        # the invoice that expires first is used first
+        self.assertEqual(m.DepositInvoice.claim().payment_request, "TEST_VALID")
+        self.assertEqual(get_bid_payment_request(), "TEST_VALID_LATER")
+        self.assertEqual([i.payment_request for i in m.DepositInvoice.query.all()], ["TEST_EXPIRING"])
+        self.assertIsNone(m.DepositInvoice.claim())
+
+    def test_claim_deposit_invoice_fallback(self):
+        m.DepositInvoice.query.delete()
+        # with an empty pool we get a new invoice from LND (which is mocked here)
+        self.assertTrue(get_bid_payment_request().startswith("MOCK_"))
+
+class TestAsyncBids(unittest.TestCase):
+    """
+    Tests the async endpoints (see asgi.py) by running them with uvicorn, next to the API, using the same database and the mock LND.
+    """
+
+    PORT = 5001
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = subprocess.Popen(["uvicorn", "asgi:app", "--port", str(cls.PORT)], cwd=os.path.dirname(os.path.abspath(__file__)))
+        for _ in range(50):
+            try:
+                requests.get(f"http://localhost:{cls.PORT}/")
+                break
+            except requests.ConnectionError:
+                time.sleep(0.2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def setUp(self):
+        with app.app_context():
+            seller = m.User(key=f"TEST_SELLER_{random.randint(0, 10 ** 9)}")
+            buyer = m.User(key=f"TEST_BUYER_{random.randint(0, 10 ** 9)}")
+            now = datetime.utcnow()
+            self.auction = m.Auction(seller=seller, key=m.Auction.generate_key(m.Auction.query.count()), title="Test", description="Test",
+                start_date=now - timedelta(hours=1), duration_hours=24, end_date=now + timedelta(hours=23), starting_bid=100, reserve_bid=0)
+            db.session.add_all([buyer, self.auction])
+            db.session.commit()
+            self.buyer_id, self.auction_key = buyer.id, self.auction.key
+            self.token = jwt.encode({'user_id': buyer.id, 'user_key': buyer.key, 'exp': now + timedelta(hours=1)}, app.config['SECRET_KEY'], "HS256")
+            db.session.remove()
+
+    def post(self, json=None, data=None, auction_key=None, token=None):
+        response = requests.post(f"http://localhost:{self.PORT}/api/auctions/{auction_key or self.auction_key}/bids",
+            json=json, data=data, headers={'X-Access-Token': token or self.token})
+        return response.status_code, response.json()
+
+    def test_bids(self):
+        code, response = self.post({'amount': 1000}, token="INVALID")
+        self.assertEqual(code, 401)
+
+        code, response = self.post(data="not json")
+        self.assertEqual(code, 400)
+        code, response = self.post({})
+        self.assertEqual(code, 400)
+        self.assertIn("amount", response['message'])
+        code, response = self.post({'amount': "a lot"})
+        self.assertEqual(code, 400)
+
+        code, response = self.post({'amount': 1000}, auction_key="NOTFOUND")
+        self.assertEqual(code, 404)
+
+        code, response = self.post({'amount': 50})
+        self.assertEqual(code, 400)
+        self.assertIn("starting bid", response['message'])
+
+        code, response = self.post({'amount': 1000})
+        self.assertEqual(code, 200)
+        self.assertTrue(response['payment_request'].startswith("MOCK_"))
+        self.assertIn("svg", response['qr'])
+        self.assertIn("You are now following this auction.", response['messages'])
+
+        with app.app_context():
+            bid = m.Bid.query.filter_by(payment_request=response['payment_request']).one()
+            self.assertEqual((bid.buyer_id, bid.amount), (self.buyer_id, 1000))
+            self.assertTrue(m.UserAuction.query.filter_by(user_id=self.buyer_id, auction_id=bid.auction_id).one().following)
+
+            # the auction is not running anymore
+            db.session.query(m.Auction).filter_by(id=bid.auction_id).update({'end_date': datetime.utcnow() - timedelta(minutes=1)})
+            db.session.commit()
+            db.session.remove()
+
+        code, response = self.post({'amount': 2000})
+        self.assertEqual(code, 403)
+
+    def test_auction_events(self):
+        response = requests.get(f"http://localhost:{self.PORT}/api/auctions/NOTFOUND/events")
+        self.assertEqual(response.status_code, 404)
+
+        with requests.get(f"http://localhost:{self.PORT}/api/auctions/{self.auction_key}/events", stream=True, timeout=10) as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.headers['Content-Type'].startswith("text/event-stream"))
+            lines = response.iter_lines(decode_unicode=True)
+            self.assertEqual(next(lines), ": connected")
+
+            with app.app_context():
+                other_auction = m.Auction.query.filter(m.Auction.key != self.auction_key).first()
+                if other_auction is not None:
+                    events.notify_auction_event(other_auction, 'bid', {'amount': 1})
+                events.notify_auction_event(m.Auction.query.filter_by(key=self.auction_key).one(), 'bid', {'amount': 1000})
+                db.session.commit()
+                db.session.remove()
+
+            # only the events of this auction are streamed
+            self.assertEqual([next(lines) for _ in range(4)], ["", "event: bid", 'data: {"amount": 1000}', ""])
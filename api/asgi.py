@@ -0,0 +1,253 @@
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+import json
+
+import asyncpg
+import grpc
+import lndgrpc.common
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from main import app as flask_app, decode_token, LAST_WRITE_COOKIE, MockLNDClient
+import events
+import models as m
+import qr
+
+# NB: this serves the endpoints that keep a request waiting for a long time, which would tie up a sync worker (thread) for all that time:
+# POST /api/auctions/<key>/bids, which gets hammered at the end of every auction and (sometimes) has to wait for LND,
+# and GET /api/auctions/<key>/events, which holds a stream open for every client looking at an auction.
+# Here a single process can keep lots of these in flight.
+# Everything else is still served by the Flask app (see api.py), and nginx routes only these requests here.
+
+class MockAsyncLNDClient:
+    async def add_invoice(self, value, **_):
+        return MockLNDClient().add_invoice(value)
+
+class AsyncLNDClient:
+    def __init__(self, address, macaroon_filepath, cert_filepath):
+        credentials = lndgrpc.common.generate_credentials(lndgrpc.common.get_cert(cert_filepath), lndgrpc.common.get_macaroon(macaroon_filepath))
+        # NB: unlike the sync channel, an aio channel reconnects by itself
+        self.channel = grpc.aio.secure_channel(address, credentials, options=[('grpc.keepalive_time_ms', 30000)])
+        self.lightning = lndgrpc.common.lnrpc.LightningStub(self.channel)
+
+    async def add_invoice(self, value, expiry):
+        return await self.lightning.AddInvoice(lndgrpc.common.ln.Invoice(value=value, expiry=expiry))
+
+class AuctionStreams:
+    """
+    Fans out auction events received by `listen_auction_events` to the streams currently open for each auction.
+    """
+
+    MAX_QUEUED_EVENTS = 100
+
+    def __init__(self):
+        self.queues = defaultdict(set)
+
+    def open(self, auction_key):
+        q = asyncio.Queue(maxsize=AuctionStreams.MAX_QUEUED_EVENTS)
+        self.queues[auction_key].add(q)
+        return q
+
+    def close(self, auction_key, q):
+        self.queues[auction_key].discard(q)
+        if not self.queues[auction_key]:
+            del self.queues[auction_key]
+
+    def put(self, q, event, data):
+        try:
+            q.put_nowait((event, data))
+        except asyncio.QueueFull:
+            pass # the client is not keeping up... dropping the event is not a big deal, since it can always GET the auction
+
+    def dispatch(self, payload):
+        if payload is None:
+            # events might have been missed, so let all clients know they should fetch the auction again
+            for qs in self.queues.values():
+                for q in qs:
+                    self.put(q, 'resync', "{}")
+            return
+
+        event = json.loads(payload)
+        for q in self.queues.get(event['auction_key'], []):
+            self.put(q, event['event'], json.dumps(event['data']))
+
+auction_streams = AuctionStreams()
+
+LISTEN_RECONNECT_SECONDS = 5
+LISTEN_CHECK_SECONDS = 30
+
+async def listen_auction_events(listening):
+    """
+    Keep a connection LISTENing to events.AUCTION_EVENTS and pass the notifications on to `auction_streams`.
+    A single connection serves all the streams open in this process. `listening` is set once the first connection is up.
+    """
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+            terminated = asyncio.Event()
+            connection.add_termination_listener(lambda _: terminated.set())
+            await connection.add_listener(events.AUCTION_EVENTS, lambda _connection, _pid, _channel, payload: auction_streams.dispatch(payload))
+            auction_streams.dispatch(None)
+            listening.set()
+            while not terminated.is_set():
+                try:
+                    await asyncio.wait_for(terminated.wait(), timeout=LISTEN_CHECK_SECONDS)
+                except asyncio.TimeoutError:
+                    # NB: an idle connection would not notice the database going away, so we poke it every now and then
+                    await connection.execute("SELECT 1")
+            flask_app.logger.error("Auction events listener disconnected.")
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            flask_app.logger.exception("Error in the auction events listener.")
+        finally:
+            if connection is not None and not connection.is_closed():
+                connection.terminate()
+        await asyncio.sleep(LISTEN_RECONNECT_SECONDS)
+
+# NB: these need to be created inside the event loop, so they are only set on startup (once in every uvicorn worker)
+engine = None
+Session = None
+lnd = None
+
+@asynccontextmanager
+async def lifespan(_):
+    global engine, Session, lnd
+    engine = create_async_engine(flask_app.config['SQLALCHEMY_DATABASE_URI'].replace("postgresql://", "postgresql+asyncpg://", 1),
+        pool_size=flask_app.config['ASYNC_DB_POOL_SIZE'])
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    if flask_app.config['MOCK_LND']:
+        lnd = MockAsyncLNDClient()
+    else:
+        lnd = AsyncLNDClient(flask_app.config['LND_GRPC'], macaroon_filepath=flask_app.config['LND_MACAROON'], cert_filepath=flask_app.config['LND_TLS_CERT'])
+    listening = asyncio.Event()
+    listener = asyncio.create_task(listen_auction_events(listening))
+    try:
+        # NB: don't start serving streams before their events can be delivered (unless the database is down, in which case the listener keeps retrying)
+        await asyncio.wait_for(listening.wait(), timeout=LISTEN_RECONNECT_SECONDS)
+    except asyncio.TimeoutError:
+        pass
+    yield
+    listener.cancel()
+    await engine.dispose()
+
+async def bids(request):
+    data = decode_token(request.headers.get('X-Access-Token'))
+    if data is None:
+        return JSONResponse({'success': False, 'message': "Invalid token."}, status_code=401)
+
+    try:
+        body = await request.json()
+    except ValueError: # NB: this includes JSON and unicode decoding errors
+        return JSONResponse({'message': "Invalid JSON."}, status_code=400)
+    if not isinstance(body, dict) or 'amount' not in body:
+        return JSONResponse({'message': "Missing key: amount."}, status_code=400)
+    try:
+        amount = int(body['amount'])
+    except (TypeError, ValueError):
+        return JSONResponse({'message': "Invalid amount."}, status_code=400)
+
+    # NB: the connection goes back to the pool before we (might) have to wait for LND, so a small pool can serve a lot of concurrent requests
+    async with Session() as session:
+        user_id = (await session.execute(select(m.User.id).filter_by(key=data['user_key']))).scalar()
+        if user_id is None:
+            return JSONResponse({'success': False, 'message': "Invalid token."}, status_code=401)
+
+        auction = (await session.execute(select(m.Auction).filter_by(key=request.path_params['key']))).scalars().first()
+        if not auction:
+            return JSONResponse({'message': "Not found."}, status_code=404)
+
+        try:
+            auction.validate_bid(amount)
+        except m.AuctionNotRunning as e:
+            return JSONResponse({'message': e.message}, status_code=403)
+        except m.ValidationError as e:
+            return JSONResponse({'message': e.message}, status_code=400)
+
+    async with Session() as session:
+        deposit_invoice = (await session.execute(m.DepositInvoice.claim_query())).scalars().first()
+        if deposit_invoice is not None:
+            payment_request = deposit_invoice.payment_request
+            await session.delete(deposit_invoice)
+            await session.execute(text("SELECT pg_notify(:channel, '')"), {'channel': events.DEPOSIT_INVOICE_EVENTS})
+        else:
+            # NB: the pool ran out (or refill-deposit-invoices is not running), so we have to wait for LND after all
+            await session.rollback()
+            flask_app.logger.warning("No deposit invoice available. Creating one...")
+            payment_request = (await lnd.add_invoice(value=flask_app.config['LND_BID_INVOICE_AMOUNT'], expiry=flask_app.config['LND_BID_INVOICE_EXPIRY'])).payment_request
+
+        session.add(m.Bid(auction_id=auction.id, buyer_id=user_id, amount=amount, payment_request=payment_request))
+        await session.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': events.PAYMENT_REQUESTS, 'payload': payment_request})
+
+        started_following = False
+        user_auction = (await session.execute(select(m.UserAuction).filter_by(user_id=user_id, auction_id=auction.id))).scalars().one_or_none()
+        if user_auction is None:
+            session.add(m.UserAuction(user_id=user_id, auction_id=auction.id, following=True))
+            started_following = True
+        else:
+            if not user_auction.following:
+                started_following = True
+                user_auction.following = True
+        await session.commit()
+
+    qr_format = request.query_params.get('qr_format')
+    qr_format = qr_format if qr_format in qr.FORMATS else qr.SVG
+
+    response = JSONResponse({
+        'payment_request': payment_request,
+        'qr': await asyncio.get_running_loop().run_in_executor(None, qr.render, payment_request, qr_format),
+        'messages': [
+            "Your bid will be confirmed once you scan the QR code.",
+        ] + (["You are now following this auction."] if started_following else []),
+    })
+    response.set_cookie(LAST_WRITE_COOKIE, "1", max_age=flask_app.config['READ_YOUR_WRITES_SECONDS'], httponly=True, samesite='lax')
+    return response
+
+async def auction_events(request):
+    """
+    Stream updates to an auction using Server-Sent Events:
+    new (settled) bids, end date changes (bids in the last minutes extend the auction) and the winner being picked.
+    Clients should GET the auction once after connecting (and again on "resync") and then just apply these events.
+    """
+
+    key = request.path_params['key']
+    async with Session() as session:
+        auction_id = (await session.execute(select(m.Auction.id).filter_by(key=key))).scalar()
+    if auction_id is None:
+        return JSONResponse({'message': "Not found."}, status_code=404)
+
+    async def stream():
+        q = auction_streams.open(key)
+        try:
+            # NB: this lets the client know that events will be delivered from now on
+            yield ": connected\n\n"
+            loop = asyncio.get_running_loop()
+            stream_until = loop.time() + flask_app.config['AUCTION_EVENTS_STREAM_DURATION']
+            while loop.time() < stream_until:
+                try:
+                    event, data = await asyncio.wait_for(q.get(), timeout=flask_app.config['AUCTION_EVENTS_KEEP_ALIVE'])
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {data}\n\n"
+        finally:
+            # NB: this also runs when the client goes away, since Starlette then cancels the response
+            auction_streams.close(key, q)
+
+    # NB: X-Accel-Buffering tells nginx not to buffer the response, so events get to the client right away
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': "no-cache", 'X-Accel-Buffering': "no"})
+
+app = Starlette(
+    debug=flask_app.config['DEBUG'],
+    routes=[
+        Route('/api/auctions/{key}/bids', bids, methods=['POST']),
+        Route('/api/auctions/{key}/events', auction_events, methods=['GET']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan)
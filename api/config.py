@@ -6,6 +6,25 @@ DEBUG = bool(int(os.environ.get("DEBUG", 0)))
 PROPAGATE_EXCEPTIONS = False
 
 BID_LAST_MINUTE_EXTEND = 5
+FINALIZE_AUCTIONS_DELAY = 30 # seconds after the end, giving settle-bids a chance to catch up with the bids paid right before it
+
+SETTLE_BIDS_BATCH_SIZE = 100
+SETTLE_BIDS_BATCH_WAIT = 0.05 # seconds
+SETTLE_BIDS_CHECKPOINT_SECONDS = 5
+SETTLE_BIDS_RESUBSCRIBE_SECONDS = 5
+SETTLE_BIDS_THREADS = int(os.environ.get("SETTLE_BIDS_THREADS", 0)) # settle the invoices of different auctions in parallel
+
+FEATURED_AUCTIONS_CACHE_TTL = 60 # seconds
+USER_CACHE_TTL = 60 # seconds
+
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 200
+
+NOTIFICATION_EVENTS_BATCH_SIZE = 100
+NOTIFICATION_DELIVERY_THREADS = 8
+
+AUCTION_EVENTS_KEEP_ALIVE = 15 # seconds
+AUCTION_EVENTS_STREAM_DURATION = 5 * 60 # seconds, after which the client will reconnect
 
 if DEBUG:
     SECRET_KEY = "DEBUG_SECRET_KEY_IS_NOT_REALLY_SECRET"
@@ -17,8 +36,8 @@ DB_USERNAME = os.environ.get('DB_USERNAME')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
 if DB_USERNAME is None or DB_PASSWORD is None:
     # NB: we check for None, not for ""
-    # for the tests we set these to "", so no secrets file is needed, but that will result in an invalid SQLALCHEMY_DATABASE_URI
-    # which is fine, since the tests should not access the database directly!
+    # for running the API tests locally we can set these to "", so no secrets file is needed, but that will result in an invalid SQLALCHEMY_DATABASE_URI
+    # which is fine, as long as we skip the tests that access the database directly (like TestSettleBids)!
     with open("/secrets/db.json") as f:
         db = json.load(f)
         if DB_USERNAME is None:
@@ -28,6 +47,17 @@ if DB_USERNAME is None or DB_PASSWORD is None:
 
 SQLALCHEMY_DATABASE_URI = f"postgresql://{DB_USERNAME}:{DB_PASSWORD}@db:5432/market"
 
+# NB: reads from endpoints marked with @replica_reads go to the replica, if one is configured
+DB_REPLICA_URI = os.environ.get('DB_REPLICA_URI')
+if DB_REPLICA_URI:
+    SQLALCHEMY_BINDS = {'replica': DB_REPLICA_URI}
+
+# after writing something, a user's reads go to the primary for this long, so they don't miss their own writes due to replication lag
+READ_YOUR_WRITES_SECONDS = 10
+
+# connections used by each worker of the async (asgi.py) api
+ASYNC_DB_POOL_SIZE = int(os.environ.get("ASYNC_DB_POOL_SIZE", 10))
+
 if bool(int(os.environ.get("SQLALCHEMY_DISABLE_POOLING", 0))):
     from sqlalchemy.pool import NullPool
     SQLALCHEMY_ENGINE_OPTIONS = {'poolclass': NullPool}
@@ -41,17 +71,42 @@ LND_TLS_CERT = "/secrets/tls.cert"
 LND_BID_INVOICE_AMOUNT = 21
 LND_BID_INVOICE_EXPIRY = 10 * 60 # 10 minutes
 LND_CONTRIBUTION_INVOICE_EXPIRY = 3 * 24 * 60 * 60 # 3 days
+
+# invoices for the bid deposit (LND_BID_INVOICE_AMOUNT) are created in advance by refill-deposit-invoices
+DEPOSIT_INVOICE_POOL_SIZE = int(os.environ.get("DEPOSIT_INVOICE_POOL_SIZE", 100))
+# NB: LND accepts a payment for as long as the invoice is valid, so these should not live much longer than LND_BID_INVOICE_EXPIRY
+# (an invoice that is not claimed within 5 minutes is replaced by a new one)
+DEPOSIT_INVOICE_EXPIRY = LND_BID_INVOICE_EXPIRY + 5 * 60
+DEPOSIT_INVOICE_REFILL_BATCH_SIZE = 20
 MINIMUM_CONTRIBUTION_AMOUNT = 21
 
 MOCK_TWITTER = bool(int(os.environ.get("MOCK_TWITTER", 0)))
 TWITTER_SECRETS = "/secrets/twitter.json"
 TWITTER_USER = "PlebeianMarket"
+TWITTER_USER_CACHE_TTL = 60 * 60 # 1 hour
+TWITTER_DM_RATE_LIMIT = 1 # DMs per second, on average
+TWITTER_DM_RATE_LIMIT_BURST = 15
+TWITTER_DM_RETRIES = 3
+TWITTER_DM_RETRY_BACKOFF = 2 # seconds, doubled after each retry
 
 MOCK_S3 = bool(int(os.environ.get("MOCK_S3", 0)))
+MOCK_S3_DIR = os.environ.get('MOCK_S3_DIR', "/tmp")
 S3_SECRETS = "/secrets/s3.json"
 S3_ENDPOINT_URL = "https://s3.us-west-004.backblazeb2.com"
 S3_BUCKET = 'plebeian-market'
 S3_FILENAME_PREFIX = os.environ.get('S3_FILENAME_PREFIX', "")
 S3_URL_PREFIX = f"https://f004.backblazeb2.com/file/{S3_BUCKET}/"
 
+QR_PROCESS_POOL_WORKERS = int(os.environ.get("QR_PROCESS_POOL_WORKERS", 0)) # 0 => render QR codes in the calling thread
+
+MEDIA_INGEST_THREADS = 4
+MEDIA_INGEST_BATCH_SIZE = 20
+MEDIA_FETCH_TIMEOUT = 10 # seconds
+MEDIA_SPOOL_MAX_MEMORY = 1024 * 1024 # bytes, larger files are spooled to disk while being fetched
+MEDIA_DERIVATIVE_SIZES = {'thumbnail': 200, 'medium': 800} # max width/height in pixels
+MEDIA_DERIVATIVE_QUALITY = 80
+MEDIA_FETCH_RETRIES = 3 # retries of each HTTP request (on connection errors or 5xx responses)
+MEDIA_FETCH_MAX_ATTEMPTS = 5 # after this many failed attempts, ingest-media gives up
+MEDIA_FETCH_RETRY_SECONDS = 30
+
 MODERATOR_USER_IDS = [int(i) for i in os.environ.get('MODERATOR_USER_IDS', "1").split(',')]
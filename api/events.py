@@ -0,0 +1,156 @@
+from collections import defaultdict
+import os
+import select
+import threading
+import time
+
+from flask import json
+import psycopg2
+import psycopg2.extensions
+from sqlalchemy import text
+
+from extensions import db
+from main import app
+
+# payload: the cache key to be invalidated
+CACHE_INVALIDATE = 'cache_invalidate'
+
+# payload: JSON object with the auction key, the event type and the event data
+AUCTION_EVENTS = 'auction_events'
+
+# no payload: this just wakes up process-notifications (which will find the actual events in the notification_events table) and finalize-auctions
+NOTIFICATION_EVENTS = 'notification_events'
+
+# no payload: this just wakes up ingest-media, which will find the media to be fetched in the media table
+MEDIA_EVENTS = 'media_events'
+
+# no payload: this just wakes up refill-deposit-invoices after invoices were taken out of the deposit_invoices table
+DEPOSIT_INVOICE_EVENTS = 'deposit_invoice_events'
+
+# payload: the payment_request of a new bid or contribution invoice, which settle-bids should expect to get settled
+PAYMENT_REQUESTS = 'payment_requests'
+
+def notify(channel, payload=""):
+    # NB: NOTIFY is transactional, so listeners will only get this once (and if) the current transaction commits
+    db.session.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': channel, 'payload': payload})
+
+def notify_auction_event(auction, event, data):
+    # NB: keep these small, as Postgres limits the payload to 8000 bytes
+    notify(AUCTION_EVENTS, json.dumps({'auction_key': auction.key, 'event': event, 'data': data}))
+
+class Listener:
+    def __init__(self, dsn, channels):
+        self.connection = psycopg2.connect(dsn)
+        self.connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.connection.cursor() as cursor:
+            for channel in channels:
+                cursor.execute(f"LISTEN {channel};")
+
+    def wait(self, timeout=None):
+        """
+        Block until at least one notification arrives or until the timeout (in seconds) expires.
+        Returns a list of (channel, payload) tuples, which is empty in case of a timeout.
+        """
+        if not self.connection.notifies:
+            select.select([self.connection], [], [], timeout)
+            self.connection.poll()
+        notifications = [(n.channel, n.payload) for n in self.connection.notifies]
+        self.connection.notifies.clear()
+        return notifications
+
+    def close(self):
+        self.connection.close()
+
+class EventHub:
+    """
+    Listens to Postgres notifications on a background thread and passes them on to the subscribed callbacks.
+    The thread is started lazily, once per process, so this is safe to use with forking servers (gunicorn).
+    """
+
+    RECONNECT_SECONDS = 5
+
+    def __init__(self):
+        self.callbacks = defaultdict(list)
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def subscribe(self, channel, callback):
+        # NB: callbacks are also called with payload=None after (re)connecting,
+        # which means that notifications might have been missed in the meantime.
+        # Also note that the set of channels is fixed once the thread is started, so subscribe to any new channels before that!
+        with self.lock:
+            self.callbacks[channel].append(callback)
+
+    def unsubscribe(self, channel, callback):
+        with self.lock:
+            self.callbacks[channel].remove(callback)
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self.run, args=(app.config['SQLALCHEMY_DATABASE_URI'],), daemon=True).start()
+
+    def dispatch(self, channel, payload):
+        with self.lock:
+            callbacks = list(self.callbacks[channel])
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception:
+                app.logger.exception(f"Error in event callback for {channel=}.")
+
+    def run(self, dsn):
+        while True:
+            try:
+                listener = Listener(dsn, list(self.callbacks))
+            except psycopg2.Error:
+                app.logger.exception("Error connecting the event listener.")
+                time.sleep(EventHub.RECONNECT_SECONDS)
+                continue
+            try:
+                for channel in list(self.callbacks):
+                    self.dispatch(channel, None)
+                while True:
+                    for channel, payload in listener.wait():
+                        self.dispatch(channel, payload)
+            except psycopg2.Error:
+                app.logger.exception("Event listener disconnected.")
+                listener.close()
+                time.sleep(EventHub.RECONNECT_SECONDS)
+
+class PaymentRequestIndex:
+    """
+    An in-memory set of payment requests that might still get settled (see PAYMENT_REQUESTS),
+    which is (re)loaded from the database using `load` whenever the hub (re)connects.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.payment_requests = set()
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+
+    def dispatch(self, payload):
+        if payload is None:
+            # NB: the hub is already listening at this point, so anything created while we load will also be received as a notification
+            with app.app_context():
+                payment_requests = set(self.load())
+            with self.lock:
+                self.payment_requests = payment_requests
+            self.loaded.set()
+        else:
+            with self.lock:
+                self.payment_requests.add(payload)
+
+    def discard(self, payment_request):
+        with self.lock:
+            self.payment_requests.discard(payment_request)
+
+    def __contains__(self, payment_request):
+        self.loaded.wait()
+        with self.lock:
+            return payment_request in self.payment_requests
+
+hub = EventHub()
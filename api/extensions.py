@@ -1,5 +1,28 @@
+from flask import g, has_app_context
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+
+REPLICA_BIND = 'replica'
+
+class RoutingSession(SignallingSession):
+    """
+    Sends reads to the read-only replica (if there is one) when the current request allows it (see replica_reads in main.py).
+    Everything else, including all flushes, goes to the primary, just like with the default session.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_app_context() and g.get('use_replica') and REPLICA_BIND in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
 
 cors = CORS()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
@@ -0,0 +1,123 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+
+import ecdsa
+import requests
+
+from main import app
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(list)
+        self.status_codes = defaultdict(lambda: defaultdict(int))
+
+    def add(self, name, duration, status_code):
+        with self.lock:
+            self.durations[name].append(duration)
+            self.status_codes[name][status_code] += 1
+
+    def report(self):
+        lines = [f"{'request':<32} {'count':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  status codes"]
+        for name, durations in sorted(self.durations.items()):
+            durations = sorted(durations)
+            p = lambda q: durations[min(len(durations) - 1, int(q * len(durations)))] * 1000
+            codes = ", ".join(f"{code}: {count}" for code, count in sorted(self.status_codes[name].items()))
+            lines.append(f"{name:<32} {len(durations):>8} {p(0.5):>8.1f} {p(0.95):>8.1f} {p(0.99):>8.1f} {durations[-1] * 1000:>8.1f}  {codes}")
+        return "\n".join(lines)
+
+class Client:
+    """
+    A simulated user, making requests using its own HTTP session (so connections are kept alive, like in a browser).
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.session = requests.Session()
+        self.token = None
+
+    def request(self, name, method, path, **kwargs):
+        headers = {'X-Access-Token': self.token} if self.token else {}
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, f"{app.config['BASE_URL']}{path}", headers=headers, timeout=30, **kwargs)
+        except requests.RequestException:
+            self.stats.add(name, time.monotonic() - start, 'error')
+            return None
+        self.stats.add(name, time.monotonic() - start, response.status_code)
+        return response.json() if response.status_code < 500 else None
+
+    def login(self):
+        response = self.request("GET /api/login", 'GET', "/api/login")
+        if not response:
+            return False
+        k1 = response['k1']
+        sk = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1)
+        sig = sk.sign_digest(bytes.fromhex(k1), sigencode=ecdsa.util.sigencode_der)
+        self.request("GET /api/login (sign)", 'GET', "/api/login", params={'k1': k1, 'key': sk.verifying_key.to_string().hex(), 'sig': sig.hex()})
+        response = self.request("GET /api/login (token)", 'GET', "/api/login", params={'k1': k1})
+        if not response or 'token' not in response:
+            return False
+        self.token = response['token']
+        return True
+
+def browse_featured(client, _):
+    featured = client.request("GET /api/auctions/featured", 'GET', "/api/auctions/featured")
+    if featured and featured['auctions']:
+        auction = random.choice(featured['auctions'])
+        client.request("GET /api/auctions/<key>", 'GET', f"/api/auctions/{auction['key']}")
+        client.request("GET /api/auctions/<key>/bids", 'GET', f"/api/auctions/{auction['key']}/bids")
+    time.sleep(random.uniform(0, 1)) # think time
+
+def login_burst(client, _):
+    client.token = None
+    client.login()
+
+def bid_storm(client, auction_key):
+    if client.token is None and not client.login():
+        return
+    response = client.request("GET /api/auctions/<key>", 'GET', f"/api/auctions/{auction_key}")
+    if not response:
+        return
+    auction = response['auction']
+    top_amount = max([b['amount'] for b in auction['bids']] + [auction['starting_bid']])
+    # NB: many of these will be rejected (because somebody else outbid us in the meantime), just like in a real bidding war at the end of an auction
+    client.request("POST /api/auctions/<key>/bids", 'POST', f"/api/auctions/{auction_key}/bids", json={'amount': top_amount + random.randint(1, 100) * 100})
+
+SCENARIOS = {
+    'featured': browse_featured,
+    'login': login_burst,
+    'bids': bid_storm,
+}
+
+def run(scenario, concurrency, duration, auction_key=None):
+    """
+    Run the scenario using `concurrency` simulated users, each of them repeating it (as fast as it can) for `duration` seconds.
+    Meant to be run against a seeded database (see `flask seed`) with the mock LND / Twitter / S3 backends.
+    """
+    if scenario == 'bids' and not auction_key:
+        featured = requests.get(f"{app.config['BASE_URL']}/api/auctions/featured").json()['auctions']
+        running = [a for a in featured if a['started'] and not a['ended']]
+        if not running:
+            raise ValueError("No running auction to bid on!")
+        auction_key = running[0]['key']
+
+    stats = Stats()
+    deadline = time.monotonic() + duration
+
+    def simulate_user():
+        client = Client(stats)
+        while time.monotonic() < deadline:
+            SCENARIOS[scenario](client, auction_key)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(simulate_user) for _ in range(concurrency)]:
+            future.result()
+    total_seconds = time.monotonic() - start
+
+    total_requests = sum(len(d) for d in stats.durations.values())
+    return f"{scenario}: {total_requests} requests in {total_seconds:.1f}s ({total_requests / total_seconds:.1f} requests/s)\n{stats.report()}"
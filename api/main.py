@@ -1,3 +1,6 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from functools import wraps
 import io
@@ -5,27 +8,39 @@ from itertools import chain
 import json
 from logging.config import dictConfig
 import os
+import queue
 import random
+import shutil
 import signal
 import string
 import sys
+import threading
 import time
 import click
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, g, jsonify, request, send_file
 from flask.cli import with_appcontext
 from flask_migrate import Migrate
 from sqlalchemy import desc
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.functions import func
 
 import boto3
 from botocore.config import Config
+from botocore.exceptions import ClientError
+import grpc
 import jwt
-import lndgrpc
+import lndgrpc.common
 import logging
 import magic
+import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1Session
+from urllib3.util.retry import Retry
 
+from cache import MemoryCache
 from extensions import cors, db
+from timers import AuctionEndTimers
 
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG')
 
@@ -68,6 +83,7 @@ def create_app():
 app = create_app()
 
 import models as m
+import events
 
 migrate = Migrate(app, db)
 
@@ -79,35 +95,324 @@ def run_tests():
     suite = unittest.TestLoader().loadTestsFromModule(api_tests)
     unittest.TextTestRunner().run(suite)
 
+@app.cli.command("run-load-tests")
+@click.option("--scenario", type=click.Choice(['featured', 'login', 'bids']), default='featured')
+@click.option("--concurrency", default=20, help="Number of simulated users.")
+@click.option("--duration", default=30, help="Duration of the test, in seconds.")
+@click.option("--auction", default=None, help="Key of the auction to bid on (for the bids scenario). Defaults to a running featured auction.")
+@with_appcontext
+def run_load_tests(scenario, concurrency, duration, auction):
+    import load_tests
+    click.echo(load_tests.run(scenario, concurrency, duration, auction))
+
+@app.cli.command("seed")
+@click.option("--users", default=1000, help="Number of users to create.")
+@click.option("--auctions", default=10000, help="Number of auctions to create.")
+@click.option("--bids", default=1000000, help="Number of bids to create.")
+@click.option("--follows", default=100000, help="Number of (user, auction) follows to create.")
+@click.option("--messages", default=100000, help="Number of messages to create.")
+@with_appcontext
+def seed_database(users, auctions, bids, follows, messages):
+    """
+    Fill the database with lots of generated data, to be used for load testing.
+    """
+    app.logger.setLevel(getattr(logging, LOG_LEVEL))
+    import seed
+    seed.seed(users, auctions, bids, follows, messages)
+
+def read_invoices(lnd, settle_index, q):
+    """
+    Put the invoices received from LND into the queue (to be run in a separate thread).
+    If the subscription is interrupted, we subscribe again, starting after the last settled invoice that we received,
+    so nothing gets lost but we also don't go through all the invoices since the last checkpoint again.
+    Any other exception gets into the queue, so the consumer can re-raise it.
+    """
+    try:
+        with app.app_context():
+            while True:
+                try:
+                    for invoice in lnd.subscribe_invoices(settle_index=settle_index):
+                        q.put(invoice)
+                        settle_index = max(settle_index, invoice.settle_index)
+                except grpc.RpcError:
+                    app.logger.exception(f"Invoice subscription interrupted. Subscribing again from {settle_index=}...")
+                    time.sleep(app.config['SETTLE_BIDS_RESUBSCRIBE_SECONDS'])
+    except Exception as e:
+        q.put(e)
+
+def get_batch(q, max_items, max_wait, timeout=None):
+    """
+    Block until there is something in the queue, then keep collecting items for up to max_wait seconds (or until we have max_items).
+    Returns an empty list if nothing arrived within the timeout.
+    """
+    try:
+        batch = [q.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    deadline = time.monotonic() + max_wait
+    while len(batch) < max_items:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(q.get(timeout=timeout))
+        except queue.Empty:
+            break
+    for item in batch:
+        if isinstance(item, Exception):
+            raise item
+    return batch
+
+def get_bid_invoice_expiry():
+    """
+    The longest a bid invoice can stay payable for, counting from when the bid was placed.
+    """
+    # NB: an invoice from the deposit invoice pool was created before the bid, so it expires at most DEPOSIT_INVOICE_EXPIRY after the bid was placed
+    return timedelta(seconds=max(app.config['LND_BID_INVOICE_EXPIRY'], app.config['DEPOSIT_INVOICE_EXPIRY']))
+
+def settle_invoices(invoices):
+    """
+    Settle the bids and contributions corresponding to the (settled) invoices, in the order they were given.
+    Returns the number of bids and contributions that were settled. The caller is responsible for committing!
+    """
+    payment_requests = [i.payment_request for i in invoices]
+    bids = {b.payment_request: b for b in db.session.query(m.Bid)
+        .options(joinedload(m.Bid.buyer))
+        .filter(m.Bid.payment_request.in_(payment_requests))}
+    # NB: the auctions of the bids are locked (always in the same order) while we update their bid stats (see Auction.bid_settled),
+    # and bid.auction will then simply find them in the session
+    auction_ids = sorted({b.auction_id for b in bids.values()})
+    if auction_ids:
+        db.session.query(m.Auction).filter(m.Auction.id.in_(auction_ids)).order_by(m.Auction.id).with_for_update().populate_existing().all()
+    contribution_auctions = {a.contribution_payment_request: a for a in db.session.query(m.Auction)
+        .filter(m.Auction.contribution_payment_request.in_(payment_requests))}
+
+    settled_count = 0
+    for invoice in invoices:
+        bid = bids.get(invoice.payment_request)
+        if bid and bid.settled_at is None and bid.rejected_at is None:
+            # NB: we go by the time the invoice was paid, not by the time we got to process it (which might be much later, after a restart)
+            paid_at = datetime.utcfromtimestamp(invoice.settle_date)
+            # NB: once the contribution was requested from the top bidder (see finalize-auctions), the top bid can't change anymore,
+            # even if this bid was paid in time, but settle-bids was lagging behind
+            if paid_at > bid.requested_at + get_bid_invoice_expiry() or paid_at > bid.auction.end_date or bid.auction.contribution_requested_at is not None:
+                # paying late must not place a bid (let alone reopen an auction that ended), but LND did accept the payment,
+                # so we keep track of it (see list-rejected-bids) and let the buyer know the deposit will be refunded
+                bid.rejected_at = datetime.utcnow()
+                db.session.add(m.Message(user_id=bid.buyer_id, key=f"BID_REJECTED_{bid.id}", notified_via=m.InternalNotificationAction().action,
+                    body=f"Your bid of {bid.amount} sats on {bid.auction.title} came in too late, after the auction ended, so it was not placed. The deposit will be refunded."))
+                app.logger.warning(f"Rejected bid paid too late: {bid.id=} {bid.requested_at=} {paid_at=}.")
+                continue
+            settled_count += 1
+            bid.settled_at = datetime.utcnow()
+            bid.auction.bid_settled(bid)
+            events.notify_auction_event(bid.auction, 'bid', bid.to_dict())
+            m.NotificationEvent.enqueue(m.NotificationEvent.BID_SETTLED, bid.auction, bid)
+            end_date = max(bid.auction.end_date, paid_at + timedelta(minutes=app.config['BID_LAST_MINUTE_EXTEND']))
+            if end_date != bid.auction.end_date:
+                bid.auction.end_date = end_date
+                events.notify_auction_event(bid.auction, 'end_date', {'end_date': end_date.isoformat() + "Z"})
+                m.NotificationEvent.enqueue(m.NotificationEvent.END_DATE_CHANGED, bid.auction)
+            # NB: auction.duration_hours should not be modified here. we use that to detect that the auction was extended!
+            app.logger.info(f"Settled bid: {bid.id=} {bid.amount=}.")
+        else:
+            auction = contribution_auctions.get(invoice.payment_request)
+            if auction and auction.contribution_settled_at is None:
+                settled_count += 1
+                auction.contribution_settled_at = datetime.utcnow()
+                winning_bid = auction.get_top_bid()
+                auction.winning_bid_id = winning_bid.id
+                events.notify_auction_event(auction, 'winner', winning_bid.to_dict())
+                app.logger.info(f"Settled contribution: {auction.id=} {auction.contribution_amount=}.")
+
+    if settled_count:
+        invalidate_cache(m.Auction.FEATURED_CACHE_KEY)
+
+    return settled_count
+
+def settle_auction_invoices(invoices):
+    """
+    Settle the invoices (which all belong to the same auction) in a transaction of their own (to be run in a separate thread).
+    """
+    with app.app_context():
+        settled_count = settle_invoices(invoices)
+        db.session.commit()
+        return settled_count
+
+def load_pending_payment_requests():
+    """
+    Get the payment requests of all the bids and contributions that are not settled yet.
+    """
+    # NB: even if an invoice expired in the meantime, it might have been paid in time, but we didn't get to process it yet
+    # (for example because settle-bids was down, or when replaying invoices after a restart), so we can't simply leave out the expired ones!
+    bids = db.session.query(m.Bid.payment_request).filter((m.Bid.settled_at == None) & (m.Bid.rejected_at == None))
+    contributions = db.session.query(m.Auction.contribution_payment_request).filter(
+        (m.Auction.contribution_payment_request != None) & (m.Auction.contribution_settled_at == None))
+
+    # However, everything we didn't process yet was settled after the last invoice we did process,
+    # so invoices that expired before that one was settled can't have been paid in time
+    state = db.session.query(m.State).filter_by(key=m.State.LAST_SETTLE_DATE).one_or_none()
+    if state is not None:
+        last_settle_date = datetime.utcfromtimestamp(int(state.value))
+        bids = bids.filter(m.Bid.requested_at >= last_settle_date - get_bid_invoice_expiry())
+        contributions = contributions.filter((m.Auction.contribution_requested_at == None)
+            | (m.Auction.contribution_requested_at >= last_settle_date - timedelta(seconds=app.config['LND_CONTRIBUTION_INVOICE_EXPIRY'])))
+
+    return [payment_request for payment_request, in bids.union_all(contributions)]
+
+def process_invoices(invoices, last_settle_index, pending_payment_requests, auction_pool=None):
+    """
+    Settle our bids and contributions, given a batch of invoices from LND, skipping the ones that were already processed (up to last_settle_index).
+    Returns the new settle index, the invoices that were ours and the number of bids and contributions that got settled.
+    NB: unless an auction_pool is used, the caller is responsible for committing!
+    """
+    settled_invoices = sorted((i for i in invoices if i.state == lndgrpc.common.ln.Invoice.SETTLED and i.settle_index > last_settle_index), key=lambda i: i.settle_index)
+    our_invoices = [i for i in settled_invoices if i.payment_request in pending_payment_requests]
+
+    settled_count = 0
+    if our_invoices and auction_pool:
+        payment_requests = [i.payment_request for i in our_invoices]
+        auction_ids = dict(db.session.query(m.Bid.payment_request, m.Bid.auction_id).filter(m.Bid.payment_request.in_(payment_requests))
+            .union_all(db.session.query(m.Auction.contribution_payment_request, m.Auction.id).filter(m.Auction.contribution_payment_request.in_(payment_requests))))
+        db.session.commit()
+        auction_invoices = defaultdict(list)
+        for invoice in our_invoices:
+            if invoice.payment_request in auction_ids:
+                auction_invoices[auction_ids[invoice.payment_request]].append(invoice)
+        settled_count = sum(auction_pool.map(settle_auction_invoices, auction_invoices.values()))
+    elif our_invoices:
+        settled_count = settle_invoices(our_invoices)
+
+    if settled_invoices:
+        last_settle_index = settled_invoices[-1].settle_index
+
+    return last_settle_index, our_invoices, settled_count
+
 @app.cli.command("settle-bids")
 @with_appcontext
 def settle_bids():
     app.logger.setLevel(getattr(logging, LOG_LEVEL))
     signal.signal(signal.SIGTERM, lambda _, __: sys.exit(0))
     lnd = get_lnd_client()
-    last_settle_index = int(db.session.query(m.State).filter_by(key=m.State.LAST_SETTLE_INDEX).first().value)
-    for invoice in lnd.subscribe_invoices(settle_index=last_settle_index):
-        if invoice.state == lndgrpc.client.ln.SETTLED and invoice.settle_index > last_settle_index:
-            found_invoice = False
-            bid = db.session.query(m.Bid).filter_by(payment_request=invoice.payment_request).first()
-            if bid:
-                found_invoice = True
-                bid.settled_at = datetime.utcnow()
-                bid.auction.end_date = max(bid.auction.end_date, datetime.utcnow() + timedelta(minutes=app.config['BID_LAST_MINUTE_EXTEND']))
-                # NB: auction.duration_hours should not be modified here. we use that to detect that the auction was extended!
-                app.logger.info(f"Settled bid: {bid.id=} {bid.amount=}.")
+    last_settle_index = checkpoint_settle_index = int(db.session.query(m.State).filter_by(key=m.State.LAST_SETTLE_INDEX).first().value)
+    checkpoint_at = time.monotonic()
+    last_settle_date = None
+
+    # NB: most of the invoices on the node have nothing to do with us, so we keep the payment requests we are waiting for in memory
+    # and skip everything else without touching the database
+    pending_payment_requests = events.PaymentRequestIndex(load_pending_payment_requests)
+    events.hub.subscribe(events.PAYMENT_REQUESTS, pending_payment_requests.dispatch)
+    events.hub.start()
+
+    # NB: when enabled, the invoices of different auctions are settled in parallel, while the invoices of the same auction
+    # are always settled in order, by the same thread, in the same transaction
+    auction_pool = ThreadPoolExecutor(max_workers=app.config['SETTLE_BIDS_THREADS']) if app.config['SETTLE_BIDS_THREADS'] else None
+
+    # NB: invoices are read from LND on a separate thread and processed in batches,
+    # so that during a bidding war we do a fixed number of queries (and a single commit) for a whole batch of invoices, rather than for each of them
+    invoices = queue.Queue()
+    threading.Thread(target=read_invoices, args=(lnd, last_settle_index, invoices), daemon=True).start()
+
+    while True:
+        batch = get_batch(invoices, app.config['SETTLE_BIDS_BATCH_SIZE'], app.config['SETTLE_BIDS_BATCH_WAIT'], timeout=app.config['SETTLE_BIDS_CHECKPOINT_SECONDS'])
+        previous_settle_index = last_settle_index
+        last_settle_index, our_invoices, settled_count = process_invoices(batch, last_settle_index, pending_payment_requests, auction_pool)
+        if last_settle_index != previous_settle_index:
+            last_settle_date = next(i.settle_date for i in batch if i.settle_index == last_settle_index)
+
+        # NB: we keep track of the settle index even if the invoices were not ours (so we don't have to go through them again after a restart),
+        # but unless something was settled (and has to be committed anyway), we only write it every once in a while
+        if last_settle_index != checkpoint_settle_index and (settled_count or time.monotonic() - checkpoint_at >= app.config['SETTLE_BIDS_CHECKPOINT_SECONDS']):
+            db.session.query(m.State).filter_by(key=m.State.LAST_SETTLE_INDEX).update({'value': str(last_settle_index)})
+            # NB: this one is used to bound the payment requests we need to keep an eye on (see load_pending_payment_requests)
+            db.session.merge(m.State(key=m.State.LAST_SETTLE_DATE, value=str(last_settle_date)))
+            checkpoint_settle_index, checkpoint_at = last_settle_index, time.monotonic()
+        db.session.commit()
+
+        for invoice in our_invoices:
+            pending_payment_requests.discard(invoice.payment_request)
+
+@app.cli.command("list-rejected-bids")
+@with_appcontext
+def list_rejected_bids():
+    """
+    List the bids that were paid too late to be placed, and whose deposits therefore need to be refunded.
+    """
+    for bid in m.Bid.query.options(joinedload(m.Bid.buyer)).filter(m.Bid.rejected_at != None).order_by(m.Bid.rejected_at):
+        click.echo(f"Bid {bid.id}: {bid.rejected_at=} {bid.auction_id=} {bid.buyer.twitter_username=} {bid.payment_request=}")
+
+@app.cli.command("check-auction-stats")
+@click.option("--fix", is_flag=True, help="Update the auctions that are out of sync.")
+@with_appcontext
+def check_auction_stats(fix):
+    """
+    Check the denormalized bid stats (top bid, number of settled bids) of all auctions against the actual bids.
+    """
+    # NB: the stats are compared by the database, so only the auctions that are out of sync (hopefully none) are ever loaded
+    bid_stats = m.Auction.bid_stats_query()
+    settled_bid_count = func.coalesce(bid_stats.c.settled_bid_count, 0)
+    out_of_sync = db.session.query(m.Auction, bid_stats.c.top_bid_id, bid_stats.c.top_bid_amount, settled_bid_count) \
+        .outerjoin(bid_stats, bid_stats.c.auction_id == m.Auction.id) \
+        .filter(m.Auction.top_bid_id.is_distinct_from(bid_stats.c.top_bid_id)
+            | m.Auction.top_bid_amount.is_distinct_from(bid_stats.c.top_bid_amount)
+            | (m.Auction.settled_bid_count != settled_bid_count)) \
+        .order_by(m.Auction.id) \
+        .all()
+    for auction, top_bid_id, top_bid_amount, settled_bid_count in out_of_sync:
+        stats = {'top_bid_id': top_bid_id, 'top_bid_amount': top_bid_amount, 'settled_bid_count': settled_bid_count}
+        click.echo(f"Auction {auction.id}: {stats=} {auction.top_bid_id=} {auction.top_bid_amount=} {auction.settled_bid_count=}")
+        if fix:
+            for k, v in stats.items():
+                setattr(auction, k, v)
+    if fix:
+        db.session.commit()
+    click.echo(f"Auctions out of sync: {len(out_of_sync)}{' (fixed)' if fix and out_of_sync else ''}.")
+
+@app.cli.command("explain-queries")
+@with_appcontext
+def explain_queries():
+    """
+    Run EXPLAIN on the query shapes used on hot paths and flag the ones that can only be answered by a sequential scan.
+    Run this against a seeded database, since Postgres would happily scan tiny tables anyway.
+    """
+    now = datetime.utcnow()
+    user = m.User.query.first()
+    auction = m.Auction.query.first()
+    if not user or not auction:
+        click.echo("Please seed the database first.")
+        sys.exit(1)
+    queries = {
+        'user by key': m.User.query.filter_by(key=user.key),
+        'auctions by seller': m.Auction.query.filter_by(seller_id=user.id).order_by(m.Auction.created_at.desc()),
+        'featured auctions': m.Auction.query.filter((m.Auction.is_featured == True) | ((m.Auction.is_featured == None) & (m.Auction.start_date <= now) & (m.Auction.end_date >= now))),
+        'auctions ending soon': m.Auction.query.filter((m.Auction.end_date <= now + timedelta(minutes=10)) & (m.Auction.end_date > now - timedelta(minutes=10))),
+        'auction by contribution invoice': m.Auction.query.filter_by(contribution_payment_request="x"),
+        'settled bids of auction': m.Bid.query.filter(m.Bid.auction_id == auction.id, m.Bid.settled_at != None),
+        'page of settled bids of auction': m.Bid.query.filter(m.Bid.auction_id == auction.id, m.Bid.settled_at != None).order_by(m.Bid.requested_at.desc(), m.Bid.id.desc()).limit(app.config['DEFAULT_PAGE_LIMIT']),
+        'bid by invoice': m.Bid.query.filter_by(payment_request="x"),
+        'user has bids': db.session.query(m.Bid.query.filter_by(buyer_id=user.id).exists()),
+        'media of auction': m.Media.query.filter_by(auction_id=auction.id),
+        'followers of auctions': m.UserAuction.query.filter(m.UserAuction.auction_id.in_([auction.id]), m.UserAuction.following == True),
+        'messages of user': m.Message.query.filter_by(user_id=user.id, notified_via='INTERNAL'),
+        'page of messages of user': m.Message.query.filter_by(user_id=user.id, notified_via='INTERNAL').order_by(m.Message.created_at.desc(), m.Message.id.desc()).limit(app.config['DEFAULT_PAGE_LIMIT']),
+        'page of all messages of user': m.Message.query.filter_by(user_id=user.id).order_by(m.Message.created_at.desc(), m.Message.id.desc()).limit(app.config['DEFAULT_PAGE_LIMIT']),
+    }
+    seq_scans = 0
+    with db.engine.connect() as connection:
+        # NB: this makes the planner use an index whenever there is one it *can* use, so any remaining Seq Scan means a missing index
+        connection.exec_driver_sql("SET enable_seqscan = off")
+        for name, query in queries.items():
+            compiled = query.statement.compile(dialect=connection.dialect, compile_kwargs={"render_postcompile": True})
+            plan = [row[0] for row in connection.exec_driver_sql("EXPLAIN " + str(compiled), compiled.params)]
+            if any("Seq Scan" in line for line in plan):
+                seq_scans += 1
+                click.echo(f"SEQ SCAN: {name}")
+                for line in plan:
+                    click.echo(f"    {line}")
             else:
-                auction = db.session.query(m.Auction).filter_by(contribution_payment_request=invoice.payment_request).first()
-                if auction:
-                    found_invoice = True
-                    auction.contribution_settled_at = datetime.utcnow()
-                    auction.winning_bid_id = auction.get_top_bid().id
-                    app.logger.info(f"Settled contribution: {auction.id=} {auction.contribution_amount=}.")
-            if found_invoice:
-                last_settle_index = invoice.settle_index
-                state = db.session.query(m.State).filter_by(key=m.State.LAST_SETTLE_INDEX).first()
-                state.value = str(last_settle_index)
-                db.session.commit()
+                click.echo(f"OK: {name}")
+    if seq_scans:
+        sys.exit(1)
 
 @app.cli.command("process-notifications")
 @with_appcontext
@@ -117,11 +422,38 @@ def process_notifications():
 
     # NB: this is used only as an optimization
     # The actual way of making sure we don't send the same notification twice is the database, namely the UNIQUE constraint on messages (user_id, key).
-    # We store this list of sent notifications in memory so we can quickly skip duplicates and not even try to execute the INSERT query.
+    # We store this list of sent notifications in memory so we can quickly skip duplicates and not even try to INSERT them.
     # However, if this process is restarted, this list will be lost, so we will attempt to send (some of) the same notifications again.
-    # That is when the database will save us as it will simply raise an integrity error.
+    # That is when the database will save us as it will simply skip those rows (INSERT ... ON CONFLICT DO NOTHING).
     sent_notifications = set()
 
+    # we sleep until either 1) a NotificationEvent is added to the "outbox" (by settle-bids or by the API when an auction starts)
+    # or 2) an auction is about to end (or to enter its last 10 minutes), which is when one of the timers fires
+    listener = events.Listener(app.config['SQLALCHEMY_DATABASE_URI'], [events.NOTIFICATION_EVENTS])
+    timers = None
+
+    # NB: messages are delivered in the background (mostly waiting for external APIs, like Twitter, where we can only send so many DMs per second),
+    # so that we can go on processing the next events (like auctions ending) in the meantime
+    delivery_pool = ThreadPoolExecutor(max_workers=app.config['NOTIFICATION_DELIVERY_THREADS'])
+
+    def deliver(message_id, action, user, message):
+        with app.app_context():
+            app.logger.info(f"Executing {action=} for {user.id=}!")
+            try:
+                notified = m.NOTIFICATION_ACTIONS[action].execute(user, message)
+            except Exception:
+                app.logger.exception(f"Error executing {action=} for {user.id=}.")
+                return
+            if notified:
+                # NB: this runs on a delivery thread, so rather than using the session (which belongs to the main thread), we use a connection of our own
+                with db.engine.begin() as connection:
+                    connection.execute(m.Message.__table__.update().where(m.Message.id == message_id).values(notified_via=action))
+            else:
+                pass
+                # Probably better to keep the Message in the DB if sending failed,
+                # since notifications are supposed to be real time sort-of,
+                # so if the delivery failed we better don't try to send it later anyway!
+
     while True:
         processing_started = datetime.utcnow()
 
@@ -131,46 +463,71 @@ def process_notifications():
             # as we don't want to send notifications for every event that happened in the past!
             state = m.State(key=m.State.LAST_PROCESSED_NOTIFICATIONS, value=str(int(processing_started.timestamp())))
             db.session.add(state)
+            db.session.query(m.NotificationEvent).delete()
             db.session.commit()
-            time.sleep(1)
             continue
 
         last_processed_notifications = datetime.fromtimestamp(int(state.value))
 
+        if timers is None:
+            # load the end dates of all auctions that end in the future or that ended (or entered their last 10 minutes) since we last ran
+            # from now on, these are kept up to date using the END_DATE_CHANGED events
+            timers = AuctionEndTimers()
+            for auction_id, end_date in db.session.query(m.Auction.id, m.Auction.end_date).filter(m.Auction.end_date > last_processed_notifications - AuctionEndTimers.WARNING_BEFORE_END):
+                timers.schedule(auction_id, end_date)
+
         total_bids = 0
         total_auctions = 0
         start_time = time.time()
 
-        # NB: we load 1) all (new) bids (since last run)
-        # and 2) all auctions that are going to end in the next 10 minutes (or ended since the last run minus 10 minutes).
+        # NB: we load 1) the next batch of events from the "outbox" (new bids, auctions starting or being extended)
+        # and 2) the auctions whose timers fired (because they are going to end in the next 10 minutes or because they just ended).
         # This ensures that notifications to be sent for new bids or for any auction ending soon or that just ended will be processed.
-        # If we want (for example) notifications for newly created auctions (regardless of end date) we would have to load auctions based on created_at.
-        for bid_or_auction in chain(
-            db.session.query(m.Bid).filter(m.Bid.settled_at > last_processed_notifications), # TODO: select related auctions to optimize?
-            db.session.query(m.Auction).filter((m.Auction.end_date <= (datetime.utcnow() + timedelta(minutes=10))) & (m.Auction.end_date > (last_processed_notifications - timedelta(minutes=10))))
-        ):
+        # If we want (for example) notifications for newly created auctions (regardless of end date) we would have to add a new type of event.
+        notification_events = db.session.query(m.NotificationEvent) \
+            .options(joinedload(m.NotificationEvent.auction), joinedload(m.NotificationEvent.bid).joinedload(m.Bid.buyer)) \
+            .order_by(m.NotificationEvent.id) \
+            .limit(app.config['NOTIFICATION_EVENTS_BATCH_SIZE']) \
+            .all()
+        notification_event_ids = [e.id for e in notification_events]
+        bids_or_auctions = [e.bid for e in notification_events if e.event_type == m.NotificationEvent.BID_SETTLED]
+
+        # an auction end date was set or changed, so its timers need to be (re)scheduled
+        # (if it ends in less than 10 minutes, a timer will fire right away)
+        for e in notification_events:
+            if e.event_type == m.NotificationEvent.END_DATE_CHANGED:
+                timers.schedule(e.auction.id, e.auction.end_date)
+
+        due_auction_ids = timers.pop_due(processing_started)
+        if due_auction_ids:
+            bids_or_auctions += db.session.query(m.Auction).filter(m.Auction.id.in_(due_auction_ids)).all()
+
+        auctions_with_bids = []
+        for bid_or_auction in bids_or_auctions:
             match bid_or_auction:
                 case m.Bid():
-                    bid = bid_or_auction
-                    auction = bid.auction
+                    auctions_with_bids.append((bid_or_auction.auction, bid_or_auction))
                     total_bids += 1
-                    app.logger.debug(f"Processing bid {bid.id=}.")
+                    app.logger.debug(f"Processing bid {bid_or_auction.id=}.")
                 case m.Auction():
-                    bid = None
-                    auction = bid_or_auction
+                    auctions_with_bids.append((bid_or_auction, None))
                     total_auctions += 1
-                    app.logger.debug(f"Processing auction {auction.id=}.")
-
-            # this could be further optimized by caching the users following the running auctions in memory,
-            # but we would need a way to invalidate/update the cache on follow/unfollow
-            following_user_ids = [ua.user_id for ua in db.session.query(m.UserAuction).filter_by(auction_id=auction.id, following=True).all()]
-            following_users = {u.id: u for u in db.session.query(m.User).filter(m.User.id.in_(following_user_ids)).all()}
-
-            # notification settings for the users following the auction - could also be cached, with the same caveat as above
-            user_notifications = {(un.user_id, un.notification_type): un for un in db.session.query(m.UserNotification).filter(m.UserNotification.user_id.in_(following_user_ids)).all()}
-
+                    app.logger.debug(f"Processing auction {bid_or_auction.id=}.")
+
+        # load the users following all the auctions touched in this run, together with their notification settings, using one query each
+        # this could be further optimized by caching the users following the running auctions in memory,
+        # but we would need a way to invalidate/update the cache on follow/unfollow
+        following_user_ids = defaultdict(list)
+        for ua in db.session.query(m.UserAuction).filter(m.UserAuction.auction_id.in_({auction.id for auction, _ in auctions_with_bids}), m.UserAuction.following == True):
+            following_user_ids[ua.auction_id].append(ua.user_id)
+        all_following_user_ids = set(chain.from_iterable(following_user_ids.values()))
+        following_users = {u.id: u for u in db.session.query(m.User).filter(m.User.id.in_(all_following_user_ids))}
+        user_notifications = {(un.user_id, un.notification_type): un for un in db.session.query(m.UserNotification).filter(m.UserNotification.user_id.in_(all_following_user_ids))}
+
+        messages_args = {}
+        for auction, bid in auctions_with_bids:
             for notification_type, notification in m.NOTIFICATION_TYPES.items():
-                for user in following_users.values():
+                for user in (following_users[user_id] for user_id in following_user_ids[auction.id]):
                     if (user.id, notification_type) not in user_notifications:
                         # this user didn't sign up for this notification type
                         continue
@@ -181,58 +538,324 @@ def process_notifications():
                         continue
 
                     if (user.id, message_args['key']) in sent_notifications:
-                        # already sent - don't even bother trying again (will fail anyway with IntegrityError)!
-                        continue
-
-                    # insert before actually trying to send anything to ensure uniqueness
-                    message = m.Message(**message_args)
-                    db.session.add(message)
-
-                    try:
-                        db.session.commit()
-                    except IntegrityError:
-                        app.logger.info(f"Duplicate message send attempt: {message_args['key']=} {message_args['user_id']=}!")
-                        db.session.rollback()
-                        # the message already exists for this user
-                        # see the comment on sent_notifications above for details
+                        # already sent - don't even bother trying again (will be skipped by the INSERT anyway)!
                         continue
 
-                    action = user_notifications[(user.id, notification_type)].action
-                    app.logger.info(f"Executing {action=} for {user.id=}!")
-                    if m.NOTIFICATION_ACTIONS[action].execute(user, message):
-                        message.notified_via = action
-                    else:
-                        pass
-                        # db.session.delete(message)
-                        # Probably better to keep the Message in the DB if sending failed,
-                        # since notifications are supposed to be real time sort-of,
-                        # so if the delivery failed we better don't try to send it later anyway!
-
-                    sent_notifications.add((user.id, message_args['key']))
-                    db.session.commit()
-
-        state = db.session.query(m.State).filter_by(key=m.State.LAST_PROCESSED_NOTIFICATIONS).first()
-        state.value = str(int(processing_started.timestamp()))
+                    messages_args[(user.id, message_args['key'])] = dict(message_args, created_at=processing_started, action=user_notifications[(user.id, notification_type)].action)
+
+        # insert before actually trying to send anything to ensure uniqueness
+        # NB: messages that already exist for a user are skipped by the database and not returned by the INSERT
+        # (see the comment on sent_notifications above for details)
+        # We commit this using a separate connection, so that the objects loaded by the session don't expire.
+        inserted_messages = []
+        if messages_args:
+            with db.engine.begin() as connection:
+                inserted_messages = connection.execute(
+                    postgresql.insert(m.Message.__table__)
+                        .values([{k: v for k, v in args.items() if k != 'action'} for args in messages_args.values()])
+                        .on_conflict_do_nothing(index_elements=['user_id', 'key'])
+                        .returning(m.Message.id, m.Message.user_id, m.Message.key)).all()
+        if len(inserted_messages) != len(messages_args):
+            app.logger.info(f"Skipped {len(messages_args) - len(inserted_messages)} duplicate message send attempts!")
+
+        # hand the messages over to the delivery threads, without waiting for them to be sent
+        # NB: the actions get (transient) copies of the users, since the objects loaded by the session must not be used by other threads
+        for message_id, user_id, key in inserted_messages:
+            message_args = dict(messages_args[(user_id, key)])
+            action = message_args.pop('action')
+            user = following_users[user_id]
+            user_copy = m.User(id=user.id, twitter_username=user.twitter_username, twitter_user_id=user.twitter_user_id)
+            delivery_pool.submit(deliver, message_id, action, user_copy, m.Message(**message_args))
+        sent_notifications.update((user_id, key) for _, user_id, key in inserted_messages)
+
+        db.session.query(m.NotificationEvent).filter(m.NotificationEvent.id.in_(notification_event_ids)).delete(synchronize_session=False)
+        if due_auction_ids:
+            state = db.session.query(m.State).filter_by(key=m.State.LAST_PROCESSED_NOTIFICATIONS).first()
+            state.value = str(int(processing_started.timestamp()))
         db.session.commit()
 
         total_seconds = time.time() - start_time
         app.logger.info(f"Processed {total_bids=} and {total_auctions=} in {total_seconds=}.")
 
-        time.sleep(1)
+        if len(notification_event_ids) == app.config['NOTIFICATION_EVENTS_BATCH_SIZE']:
+            continue # there might be more events waiting
+
+        # the next time we need to check auctions is when the next timer fires
+        next_timer_at = timers.next_at()
+        listener.wait(timeout=max(0, (next_timer_at - datetime.utcnow()).total_seconds()) if next_timer_at else None)
+
+def finalize_auction(auction):
+    """
+    Ask the top bidder of an auction that ended for the contribution (or pick the winner right away, if the contribution is too small).
+    The auction should be locked by the caller, who is also responsible for committing!
+    """
+    top_bid = auction.get_top_bid()
+    auction.contribution_amount = int(auction.seller.contribution_percent / 100 * top_bid.amount)
+    if auction.contribution_amount < app.config['MINIMUM_CONTRIBUTION_AMOUNT']:
+        auction.contribution_amount = 0 # probably not worth the fees, at least in the next few years
+
+        # settle the contribution and pick the winner right away
+        auction.contribution_requested_at = auction.contribution_settled_at = datetime.utcnow()
+        auction.winning_bid_id = top_bid.id
+        events.notify_auction_event(auction, 'winner', top_bid.to_dict())
+    else:
+        response = get_lnd_client().add_invoice(value=auction.contribution_amount, expiry=app.config['LND_CONTRIBUTION_INVOICE_EXPIRY'])
+        auction.contribution_payment_request = response.payment_request
+        events.notify(events.PAYMENT_REQUESTS, auction.contribution_payment_request)
+        auction.contribution_requested_at = datetime.utcnow()
+        events.notify_auction_event(auction, 'contribution', {'contribution_amount': auction.contribution_amount})
+    invalidate_cache(m.Auction.FEATURED_CACHE_KEY)
+
+@app.cli.command("finalize-auctions")
+@with_appcontext
+def finalize_auctions():
+    """
+    Once an auction ends (with the reserve bid reached), finalize it (see finalize_auction).
+    Each auction is finalized exactly once, here, rather than by whichever request happens to GET the auction first.
+    """
+    app.logger.setLevel(getattr(logging, LOG_LEVEL))
+    signal.signal(signal.SIGTERM, lambda _, __: sys.exit(0))
+
+    # NB: we are woken up when end dates change or bids settle (both of which also notify process-notifications)
+    listener = events.Listener(app.config['SQLALCHEMY_DATABASE_URI'], [events.NOTIFICATION_EVENTS])
+
+    not_finalized = (m.Auction.winning_bid_id == None) & (m.Auction.contribution_requested_at == None)
+
+    # NB: bids paid right before the end might still be on their way through settle-bids (and might extend the auction),
+    # while any bid settled after the auction was finalized is rejected (see settle_invoices)
+    delay = timedelta(seconds=app.config['FINALIZE_AUCTIONS_DELAY'])
+
+    while True:
+        now = datetime.utcnow()
+
+        # NB: SKIP LOCKED makes it safe to run more than one of these, as each auction can only be picked by one of them
+        auction = db.session.query(m.Auction) \
+            .filter(not_finalized & (m.Auction.end_date < now - delay) & (m.Auction.top_bid_amount != None) & (m.Auction.top_bid_amount >= m.Auction.reserve_bid)) \
+            .order_by(m.Auction.end_date) \
+            .with_for_update(skip_locked=True) \
+            .first()
+
+        if auction:
+            finalize_auction(auction)
+            db.session.commit()
+            app.logger.info(f"Finalized auction: {auction.id=} {auction.contribution_amount=}.")
+            continue # there might be more auctions waiting
+
+        next_end_date = db.session.query(func.min(m.Auction.end_date)).filter(not_finalized & (m.Auction.end_date >= now - delay)).scalar()
+        db.session.commit()
+
+        listener.wait(timeout=max(0, (next_end_date + delay - datetime.utcnow()).total_seconds()) if next_end_date else None)
+
+@app.cli.command("refill-deposit-invoices")
+@with_appcontext
+def refill_deposit_invoices():
+    """
+    Keep DEPOSIT_INVOICE_POOL_SIZE invoices for bid deposits ready to be used, replacing the ones that are about to expire.
+    """
+    app.logger.setLevel(getattr(logging, LOG_LEVEL))
+    signal.signal(signal.SIGTERM, lambda _, __: sys.exit(0))
+
+    lnd = get_lnd_client()
+    listener = events.Listener(app.config['SQLALCHEMY_DATABASE_URI'], [events.DEPOSIT_INVOICE_EVENTS])
+
+    # NB: an invoice is only handed out if it is still valid for at least LND_BID_INVOICE_EXPIRY (see DepositInvoice.claim_query)
+    min_validity = timedelta(seconds=app.config['LND_BID_INVOICE_EXPIRY'])
+
+    while True:
+        expired_count = db.session.query(m.DepositInvoice).filter(m.DepositInvoice.expires_at <= datetime.utcnow() + min_validity).delete()
+        if expired_count:
+            app.logger.info(f"Removed {expired_count} expiring deposit invoices.")
+
+        missing_count = app.config['DEPOSIT_INVOICE_POOL_SIZE'] - db.session.query(func.count(m.DepositInvoice.id)).scalar()
+        for _ in range(min(missing_count, app.config['DEPOSIT_INVOICE_REFILL_BATCH_SIZE'])):
+            expires_at = datetime.utcnow() + timedelta(seconds=app.config['DEPOSIT_INVOICE_EXPIRY'])
+            response = lnd.add_invoice(value=app.config['LND_BID_INVOICE_AMOUNT'], expiry=app.config['DEPOSIT_INVOICE_EXPIRY'])
+            db.session.add(m.DepositInvoice(payment_request=response.payment_request, expires_at=expires_at))
+        db.session.commit()
+
+        if missing_count > app.config['DEPOSIT_INVOICE_REFILL_BATCH_SIZE']:
+            app.logger.info(f"Added {app.config['DEPOSIT_INVOICE_REFILL_BATCH_SIZE']} deposit invoices.")
+            continue # the new invoices are already available, but the pool is not full yet
+        elif missing_count > 0:
+            app.logger.info(f"Added {missing_count} deposit invoices.")
+
+        next_expires_at = db.session.query(func.min(m.DepositInvoice.expires_at)).scalar()
+        db.session.commit()
+
+        listener.wait(timeout=max(0, (next_expires_at - min_validity - datetime.utcnow()).total_seconds()) if next_expires_at else None)
+
+@app.cli.command("ingest-media")
+@with_appcontext
+def ingest_media():
+    """
+    Fetch the media (pictures from tweets) and the Twitter profile pictures added by the API and upload them to S3.
+    """
+    app.logger.setLevel(getattr(logging, LOG_LEVEL))
+    signal.signal(signal.SIGTERM, lambda _, __: sys.exit(0))
+
+    listener = events.Listener(app.config['SQLALCHEMY_DATABASE_URI'], [events.MEDIA_EVENTS])
+
+    # NB: a requests.Session keeps connections alive, but it is not officially thread safe,
+    # so we use one session per thread, each of them reused across all the downloads done by that thread
+    sessions = threading.local()
+    def get_session():
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+            retry = Retry(total=app.config['MEDIA_FETCH_RETRIES'], backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+            sessions.session.mount("https://", HTTPAdapter(max_retries=retry))
+            sessions.session.mount("http://", HTTPAdapter(max_retries=retry))
+        return sessions.session
+
+    s3 = get_s3()
+
+    def fetch(url):
+        try:
+            return m.fetch_image(url, s3, get_session())
+        except Exception:
+            app.logger.exception(f"Error fetching {url=}.")
+            return None
+
+    fetch_pool = ThreadPoolExecutor(max_workers=app.config['MEDIA_INGEST_THREADS'])
+
+    while True:
+        # NB: SKIP LOCKED makes it safe to run more than one of these
+        pending_media = db.session.query(m.Media) \
+            .filter((m.Media.fetched_at == None) & (m.Media.fetch_attempts < app.config['MEDIA_FETCH_MAX_ATTEMPTS'])) \
+            .order_by(m.Media.fetch_attempts, m.Media.id) \
+            .limit(app.config['MEDIA_INGEST_BATCH_SIZE']) \
+            .with_for_update(skip_locked=True) \
+            .all()
+
+        failed = False
+        for media, urls in zip(pending_media, fetch_pool.map(fetch, [media.url for media in pending_media])):
+            if urls:
+                media.url = urls['original']
+                media.thumbnail_url = urls.get('thumbnail')
+                media.medium_url = urls.get('medium')
+                media.fetched_at = datetime.utcnow()
+                app.logger.info(f"Fetched media {media.id=}.")
+            else:
+                media.fetch_attempts += 1
+                failed = True
+                app.logger.warning(f"Failed fetching media {media.id=} {media.fetch_attempts=}.")
+        if pending_media:
+            invalidate_cache(m.Auction.FEATURED_CACHE_KEY)
+        db.session.commit()
+
+        pending_users = db.session.query(m.User) \
+            .filter((m.User.twitter_profile_image_pending_url != None) & (m.User.twitter_profile_image_fetch_attempts < app.config['MEDIA_FETCH_MAX_ATTEMPTS'])) \
+            .order_by(m.User.twitter_profile_image_fetch_attempts, m.User.id) \
+            .limit(app.config['MEDIA_INGEST_BATCH_SIZE']) \
+            .with_for_update(skip_locked=True) \
+            .all()
+
+        for user, urls in zip(pending_users, fetch_pool.map(fetch, [user.twitter_profile_image_pending_url for user in pending_users])):
+            if urls:
+                user.twitter_profile_image_url = urls['original']
+                user.twitter_profile_image_thumbnail_url = urls.get('thumbnail')
+                user.twitter_profile_image_pending_url = None
+                app.logger.info(f"Fetched profile picture of {user.id=}.")
+            else:
+                user.twitter_profile_image_fetch_attempts += 1
+                failed = True
+                app.logger.warning(f"Failed fetching profile picture of {user.id=} {user.twitter_profile_image_fetch_attempts=}.")
+            invalidate_cache(m.User.get_cache_key(user.key))
+        if pending_users:
+            invalidate_cache(m.Auction.FEATURED_CACHE_KEY)
+        db.session.commit()
+
+        if len(pending_media) == app.config['MEDIA_INGEST_BATCH_SIZE'] or len(pending_users) == app.config['MEDIA_INGEST_BATCH_SIZE']:
+            continue # there might be more media waiting
+
+        listener.wait(timeout=app.config['MEDIA_FETCH_RETRY_SECONDS'] if failed else None)
+
+_cache = MemoryCache()
+
+# keep the caches of all processes in sync: any process can invalidate a key by sending a notification
+events.hub.subscribe(events.CACHE_INVALIDATE, lambda key: _cache.delete(key) if key is not None else _cache.clear())
+
+def get_cache():
+    # NB: this is an in-process cache, so the event hub needs to be running in order to receive invalidations from other processes.
+    # A shared cache (implementing the same interface as MemoryCache) could be returned here instead.
+    events.hub.start()
+    return _cache
+
+def invalidate_cache(key):
+    _cache.delete(key)
+    events.notify(events.CACHE_INVALIDATE, key)
 
 def get_token_from_request():
     return request.headers.get('X-Access-Token')
 
-def get_user_from_token(token):
+def decode_token(token):
     if not token:
         return None
 
     try:
-        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+        return jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
     except Exception:
         return None
 
-    return m.User.query.filter_by(key=data['user_key']).first()
+def get_user_from_token(token):
+    data = decode_token(token)
+    if data is None:
+        return None
+
+    cache = get_cache()
+    cache_key = m.User.get_cache_key(data['user_key'])
+    cached_user = cache.get(cache_key)
+    if cached_user is not None:
+        # NB: the cached object is detached and shared between threads, so we always work with a copy that belongs to the current session
+        return db.session.merge(cached_user, load=False)
+
+    # NB: the cached user is shared by all requests (and only invalidated when it changes), so it should not come from a replica that might be behind
+    with primary_reads():
+        if 'user_id' in data:
+            user = db.session.get(m.User, data['user_id'])
+            if user is not None and user.key != data['user_key']:
+                return None
+        else:
+            # tokens issued before we started including the user_id
+            user = m.User.query.filter_by(key=data['user_key']).first()
+
+    if user is not None:
+        cache.set(cache_key, user.detached_copy(), app.config['USER_CACHE_TTL'])
+
+    return user
+
+LAST_WRITE_COOKIE = 'last_write'
+
+def replica_reads(f):
+    """
+    Let the database reads of this (side-effect free) endpoint go to the read-only replica,
+    unless the user wrote something recently, in which case the replica might not have caught up yet.
+    Must be applied before (above) user_required, so the user is also read from the replica.
+    """
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        g.use_replica = request.method == 'GET' and LAST_WRITE_COOKIE not in request.cookies
+        return f(*args, **kwargs)
+    return decorator
+
+@contextmanager
+def primary_reads():
+    """
+    Send the reads done inside this block to the primary, even if the endpoint is marked with @replica_reads.
+    Use this when filling the shared caches, which would otherwise keep serving whatever the replica had at that time.
+    """
+    use_replica = g.get('use_replica')
+    g.use_replica = False
+    try:
+        yield
+    finally:
+        g.use_replica = use_replica
+
+@app.after_request
+def set_last_write_cookie(response):
+    # NB: the cookie simply expires once the replica is expected to have caught up
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+        response.set_cookie(LAST_WRITE_COOKIE, "1", max_age=app.config['READ_YOUR_WRITES_SECONDS'], httponly=True, samesite='Lax')
+    return response
 
 def user_required(f):
     @wraps(f)
@@ -248,13 +871,14 @@ def user_required(f):
 
 class MockLNDClient:
     class InvoiceResponse:
-        def __init__(self, payment_request=None, state=None, settle_index=None):
+        def __init__(self, payment_request=None, state=None, settle_index=None, settle_date=None):
             if payment_request:
                 self.payment_request = payment_request
             else:
                 self.payment_request = "MOCK_" + ''.join(random.choice(string.ascii_lowercase) for i in range(8))
             self.state = state
             self.settle_index = settle_index
+            self.settle_date = settle_date if settle_date is not None else int(time.time())
 
     def add_invoice(self, value, **_):
         return MockLNDClient.InvoiceResponse()
@@ -265,16 +889,90 @@ class MockLNDClient:
             time.sleep(3)
             for unsettled_bid in db.session.query(m.Bid).filter(m.Bid.settled_at == None):
                 last_settle_index += 1
-                yield MockLNDClient.InvoiceResponse(unsettled_bid.payment_request, lndgrpc.client.ln.SETTLED, last_settle_index)
+                yield MockLNDClient.InvoiceResponse(unsettled_bid.payment_request, lndgrpc.common.ln.Invoice.SETTLED, last_settle_index)
             for unsettled_contribution in db.session.query(m.Auction).filter(m.Auction.contribution_settled_at == None):
                 last_settle_index += 1
-                yield MockLNDClient.InvoiceResponse(unsettled_contribution.contribution_payment_request, lndgrpc.client.ln.SETTLED, last_settle_index)
+                yield MockLNDClient.InvoiceResponse(unsettled_contribution.contribution_payment_request, lndgrpc.common.ln.Invoice.SETTLED, last_settle_index)
+
+class LNDClient:
+    # NB: unlike lndgrpc.LNDClient, which opens a new channel for every call, this keeps using the same channel (and TLS connection)
+    def __init__(self, address, macaroon_filepath, cert_filepath):
+        self.address = address
+        self.credentials = lndgrpc.common.generate_credentials(lndgrpc.common.get_cert(cert_filepath), lndgrpc.common.get_macaroon(macaroon_filepath))
+        self.connect()
+
+    def connect(self):
+        self.channel = grpc.secure_channel(self.address, self.credentials, options=[('grpc.keepalive_time_ms', 30000)])
+        self.lightning = lndgrpc.common.lnrpc.LightningStub(self.channel)
+
+    def call(self, method, request):
+        try:
+            return getattr(self.lightning, method)(request)
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.UNAVAILABLE:
+                raise
+            # the channel might have been broken (for example if LND restarted), so try once more using a new one
+            app.logger.warning(f"LND unavailable when calling {method}. Reconnecting...")
+            self.channel.close()
+            self.connect()
+            return getattr(self.lightning, method)(request)
+
+    def add_invoice(self, value, expiry):
+        return self.call('AddInvoice', lndgrpc.common.ln.Invoice(value=value, expiry=expiry))
+
+    def subscribe_invoices(self, settle_index):
+        return self.call('SubscribeInvoices', lndgrpc.common.ln.InvoiceSubscription(settle_index=settle_index))
+
+class ProcessLocal:
+    """
+    Lazily creates an object (like an API client) using the factory and keeps returning the same one.
+    A new one is created in every process, since network connections should not be shared between forked processes (gunicorn workers).
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.pid = None
+        self.value = None
+
+    def get(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.value = self.factory()
+                self.pid = os.getpid()
+            return self.value
+
+class ThreadLocal:
+    """
+    Like ProcessLocal, but creates a new object in every thread, for objects that are not thread safe (like requests sessions).
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.local = threading.local()
+
+    def get(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.value = self.factory()
+            self.local.pid = os.getpid()
+        return self.local.value
+
+_lnd_client = ProcessLocal(lambda: MockLNDClient() if app.config['MOCK_LND'] else LNDClient(app.config['LND_GRPC'], macaroon_filepath=app.config['LND_MACAROON'], cert_filepath=app.config['LND_TLS_CERT']))
 
 def get_lnd_client():
-    if app.config['MOCK_LND']:
-        return MockLNDClient()
-    else:
-        return lndgrpc.LNDClient(app.config['LND_GRPC'], macaroon_filepath=app.config['LND_MACAROON'], cert_filepath=app.config['LND_TLS_CERT'])
+    return _lnd_client.get()
+
+def get_bid_payment_request():
+    """
+    Get a payment request for the deposit of a new bid, preferably from the pool of pre-generated invoices (see refill-deposit-invoices).
+    Must be called as part of the transaction that adds the bid!
+    """
+    deposit_invoice = m.DepositInvoice.claim()
+    if deposit_invoice is not None:
+        return deposit_invoice.payment_request
+    # NB: the pool ran out (or refill-deposit-invoices is not running), so we have to wait for LND after all
+    app.logger.warning("No deposit invoice available. Creating one...")
+    return get_lnd_client().add_invoice(value=app.config['LND_BID_INVOICE_AMOUNT'], expiry=app.config['LND_BID_INVOICE_EXPIRY']).payment_request
 
 class MockTwitter:
     class MockKey:
@@ -284,7 +982,13 @@ class MockTwitter:
     def __init__(self, **__):
         pass
 
+    def invalidate_user(self, username):
+        pass
+
     def get_user(self, username):
+        return self.fetch_user(username)
+
+    def fetch_user(self, username):
         return {
             'id': "MOCK_USER_ID",
             'profile_image_url': f"https://api.lorem.space/image/face?hash={random.randint(1, 1000)}",
@@ -315,6 +1019,17 @@ class MockTwitter:
         # but we are testing the notifications mechanism - so assume the DM went through
         return True
 
+class TwitterError(Exception):
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"Twitter error: {status_code=}")
+        self.status_code = status_code # None if we did not get a response at all
+        self.retry_after = retry_after # seconds, if Twitter told us when the rate limit resets
+
+    @property
+    def transient(self):
+        # NB: there is no point in retrying other client errors (invalid recipient, user not accepting DMs, bad credentials...)
+        return self.status_code is None or self.status_code == 429 or self.status_code >= 500
+
 class Twitter:
     BASE_URL = "https://api.twitter.com"
     URL_PREFIXES = ["http://plebeian.market/auctions/", "https://plebeian.market/auctions/", "http://staging.plebeian.market/auctions/", "https://staging.plebeian.market/auctions/"]
@@ -337,7 +1052,25 @@ class Twitter:
             app.logger.error(f"Error when POSTing to Twitter -> {path}: {response.status_code=} {response.text=}")
             return False
 
+    @staticmethod
+    def get_user_cache_key(username):
+        return f"twitter_user_{username.lower()}"
+
+    def invalidate_user(self, username):
+        invalidate_cache(Twitter.get_user_cache_key(username))
+
     def get_user(self, username):
+        # NB: this is called for every DM we send (unless we know the user's ID already), every profile update and every auction start,
+        # so we cache it to not run into Twitter's rate limits
+        cache = get_cache()
+        twitter_user = cache.get(Twitter.get_user_cache_key(username))
+        if twitter_user is None:
+            twitter_user = self.fetch_user(username)
+            if twitter_user:
+                cache.set(Twitter.get_user_cache_key(username), twitter_user, app.config['TWITTER_USER_CACHE_TTL'])
+        return twitter_user
+
+    def fetch_user(self, username):
         response_json = self.get(f"/2/users/by/username/{username}",
             params={
                 'user.fields': "location,name,profile_image_url,pinned_tweet_id",
@@ -400,19 +1133,32 @@ class Twitter:
         return auction_tweets
 
     def send_dm(self, user_id, body):
-        response_json = self.post(f"/1.1/direct_messages/events/new.json",
-            params_json={
-                'event': {
-                    'type': 'message_create',
-                    'message_create': {
-                        'target': {'recipient_id': user_id},
-                        'message_data': {'text': body},
+        """
+        Returns True if the DM was sent, otherwise raises TwitterError (which says whether it makes sense to try again).
+        """
+        try:
+            response = self.session.post(f"{Twitter.BASE_URL}/1.1/direct_messages/events/new.json",
+                json={
+                    'event': {
+                        'type': 'message_create',
+                        'message_create': {
+                            'target': {'recipient_id': user_id},
+                            'message_data': {'text': body},
+                        }
                     }
-                }
-            })
-        return bool(response_json)
-
-def get_twitter():
+                })
+        except requests.RequestException as e:
+            raise TwitterError(None) from e
+        if response.status_code == 200:
+            return True
+        app.logger.error(f"Error when sending Twitter DM: {response.status_code=} {response.text=}")
+        retry_after = None
+        if response.status_code == 429 and 'x-rate-limit-reset' in response.headers:
+            # NB: the header is the time (in epoch seconds) when the rate limit window resets
+            retry_after = max(0, int(response.headers['x-rate-limit-reset']) - time.time())
+        raise TwitterError(response.status_code, retry_after)
+
+def create_twitter():
     if app.config['MOCK_TWITTER']:
         return MockTwitter()
     else:
@@ -424,6 +1170,17 @@ def get_twitter():
         access_token_secret = twitter_secrets['ACCESS_TOKEN_SECRET']
         return Twitter(api_key, api_key_secret, access_token, access_token_secret)
 
+_qr_pool = ProcessLocal(lambda: ProcessPoolExecutor(app.config['QR_PROCESS_POOL_WORKERS']) if app.config['QR_PROCESS_POOL_WORKERS'] else None)
+
+def get_qr_pool():
+    return _qr_pool.get()
+
+_twitter = ThreadLocal(create_twitter)
+
+def get_twitter():
+    # NB: each thread reuses its own session for all requests, so HTTP connections are kept alive
+    return _twitter.get()
+
 class MockS3:
     def get_url_prefix(self):
         return app.config['BASE_URL'] + "/mock-s3-files/"
@@ -431,16 +1188,20 @@ class MockS3:
     def get_filename_prefix(self):
         return ""
 
-    def upload(self, data, filename):
+    def exists(self, filename):
+        return os.path.exists(os.path.join(app.config['MOCK_S3_DIR'], self.get_filename_prefix() + filename))
+
+    def upload(self, fileobj, filename):
         filename_with_prefix = self.get_filename_prefix() + filename
         app.logger.info(f"Upload {filename_with_prefix} to MockS3!")
-        with open(f"/tmp/{filename_with_prefix}", "wb") as f:
-            # basically store the content under /tmp to be used by the /mock-s3-files/ route later
-            f.write(data)
+        with open(os.path.join(app.config['MOCK_S3_DIR'], filename_with_prefix), "wb") as f:
+            # basically store the content under MOCK_S3_DIR to be used by the /mock-s3-files/ route later
+            shutil.copyfileobj(fileobj, f)
 
 class S3:
     def __init__(self, endpoint_url, key_id, application_key):
-        self.s3 = boto3.resource(service_name='s3', endpoint_url=endpoint_url, aws_access_key_id=key_id, aws_secret_access_key=application_key, config=Config(signature_version='s3v4'))
+        # NB: boto3 clients (unlike resources) are thread safe
+        self.s3 = boto3.client(service_name='s3', endpoint_url=endpoint_url, aws_access_key_id=key_id, aws_secret_access_key=application_key, config=Config(signature_version='s3v4'))
 
     def get_url_prefix(self):
         return app.config['S3_URL_PREFIX']
@@ -448,10 +1209,20 @@ class S3:
     def get_filename_prefix(self):
         return app.config['S3_FILENAME_PREFIX']
 
-    def upload(self, data, filename):
-        self.s3.Bucket(app.config['S3_BUCKET']).upload_fileobj(io.BytesIO(data), self.get_filename_prefix() + filename)
+    def exists(self, filename):
+        try:
+            self.s3.head_object(Bucket=app.config['S3_BUCKET'], Key=self.get_filename_prefix() + filename)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
 
-def get_s3():
+    def upload(self, fileobj, filename):
+        # NB: upload_fileobj reads the file in chunks (using a multipart upload for large files)
+        self.s3.upload_fileobj(fileobj, app.config['S3_BUCKET'], self.get_filename_prefix() + filename)
+
+def create_s3():
     if app.config['MOCK_S3']:
         return MockS3()
     else:
@@ -459,6 +1230,11 @@ def get_s3():
             s3_secrets = json.load(f)
         return S3(app.config['S3_ENDPOINT_URL'], s3_secrets['KEY_ID'], s3_secrets['APPLICATION_KEY'])
 
+_s3 = ProcessLocal(create_s3)
+
+def get_s3():
+    return _s3.get()
+
 if __name__ == '__main__':
     import lnurl
     try:
@@ -475,7 +1251,7 @@ if __name__ == '__main__':
     @app.route("/mock-s3-files/<string:filename>", methods=['GET'])
     def mock_s3(filename):
         app.logger.info(f"Fetch {filename} from MockS3!")
-        with open(f"/tmp/{filename}", "rb") as f:
+        with open(os.path.join(app.config['MOCK_S3_DIR'], filename), "rb") as f:
             data = f.read()
             return send_file(io.BytesIO(data), mimetype=magic.from_buffer(data, mime=True))
 
@@ -4,48 +4,149 @@ from collections import OrderedDict
 from datetime import datetime, timedelta
 import dateutil.parser
 import hashlib
-from io import BytesIO
 import math
 from os import urandom
 import random
 import string
+import tempfile
+import threading
+import time
 import bleach
 import magic
-import pyqrcode
+from PIL import Image, ImageOps
 import requests
+from sqlalchemy.orm import joinedload, make_transient_to_detached, selectinload
 
 from extensions import db
 from main import app
-
-def fetch_image(url, s3, filename):
-    response = requests.get(url)
-    if response.status_code != 200:
-        return None
-
-    original_ext = url.rsplit('.', 1)[-1]
-    guessed_ext = magic.Magic(extension=True).from_buffer(response.content).split("/")[0]
-    for e in [guessed_ext, original_ext]:
-        if e.isalnum() and len(e) <= 5:
-            ext = f".{e}"
-            break
-    else:
-        ext = ""
-
-    filename = f"{filename}{ext}"
-
-    s3.upload(response.content, filename)
-
-    return s3.get_url_prefix() + s3.get_filename_prefix() + filename
+import qr
+
+# NB: creating a Magic object loads the whole magic database, so we reuse one, but libmagic is not thread safe
+_magic = magic.Magic(extension=True)
+_magic_lock = threading.Lock()
+
+def guess_extension(data):
+    with _magic_lock:
+        return _magic.from_buffer(data).split("/")[0]
+
+def make_derivatives(f, s3, name):
+    """
+    Create smaller (WebP) versions of the image in f and upload them next to the original.
+    Returns the URLs of the derivatives, keyed by size (for example 'thumbnail'), which is empty if the image can't be decoded.
+    """
+    try:
+        f.seek(0)
+        image = Image.open(f)
+        image.load()
+    except (OSError, Image.DecompressionBombError): # NB: UnidentifiedImageError is an OSError too
+        app.logger.warning(f"Could not decode image {name}.")
+        return {}
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if image.mode in ('LA', 'PA') or 'transparency' in image.info else 'RGB')
+
+    urls = {}
+    for size, max_dimension in app.config['MEDIA_DERIVATIVE_SIZES'].items():
+        filename = f"{name}_{size}.webp"
+        if not s3.exists(filename):
+            derivative = image.copy()
+            derivative.thumbnail((max_dimension, max_dimension)) # NB: this never makes the image larger
+            with tempfile.SpooledTemporaryFile(max_size=app.config['MEDIA_SPOOL_MAX_MEMORY']) as out:
+                derivative.save(out, 'WEBP', quality=app.config['MEDIA_DERIVATIVE_QUALITY'])
+                out.seek(0)
+                s3.upload(out, filename)
+        urls[size] = s3.get_url_prefix() + s3.get_filename_prefix() + filename
+    return urls
+
+def fetch_image(url, s3, session=requests):
+    """
+    Download the image (without ever holding all of it in memory) and upload it to S3, unless it was already uploaded before.
+    Files are stored under the SHA-256 of their content, so the same image always ends up with the same URL.
+    Returns a dict with the URL of the 'original' and the URLs of the derivatives (see make_derivatives), or None if the download failed.
+    """
+    with session.get(url, timeout=app.config['MEDIA_FETCH_TIMEOUT'], stream=True) as response:
+        if response.status_code != 200:
+            return None
+
+        with tempfile.SpooledTemporaryFile(max_size=app.config['MEDIA_SPOOL_MAX_MEMORY']) as f:
+            sha256 = hashlib.sha256()
+            guessed_ext = None
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                if guessed_ext is None:
+                    guessed_ext = guess_extension(chunk) # the beginning of the file is enough for libmagic
+                sha256.update(chunk)
+                f.write(chunk)
+
+            original_ext = url.rsplit('.', 1)[-1]
+            for e in [guessed_ext or "", original_ext]:
+                if e.isalnum() and len(e) <= 5:
+                    ext = f".{e}"
+                    break
+            else:
+                ext = ""
+
+            filename = f"{sha256.hexdigest()}{ext}"
+
+            if not s3.exists(filename):
+                f.seek(0)
+                s3.upload(f, filename)
+
+            urls = make_derivatives(f, s3, sha256.hexdigest())
+
+    urls['original'] = s3.get_url_prefix() + s3.get_filename_prefix() + filename
+    return urls
+
+class TokenBucket:
+    """
+    Rate limiter allowing, on average, `rate` operations per second, with bursts of up to `capacity` operations.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Don't allow any operations for the next `seconds` (for example because the server asked us to back off).
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # NB: several threads might get told to back off at the same time, so the pauses don't add up
+            self.tokens = min(self.tokens, -seconds * self.rate)
 
 class ValidationError(Exception):
     def __init__(self, message):
         super().__init__()
         self.message = message
 
+class AuctionNotRunning(ValidationError):
+    def __init__(self):
+        super().__init__("Auction not running.")
+
 class State(db.Model):
     __tablename__ = 'state'
 
     LAST_SETTLE_INDEX = 'LAST_SETTLE_INDEX'
+    LAST_SETTLE_DATE = 'LAST_SETTLE_DATE'
     LAST_PROCESSED_NOTIFICATIONS = 'LAST_PROCESSED_NOTIFICATIONS'
 
     key = db.Column(db.String(32), primary_key=True)
@@ -64,6 +165,9 @@ class LnAuth(db.Model):
 class User(db.Model):
     __tablename__ = 'users'
 
+    # NB: ingest-media looks for the profile pictures that still need to be fetched
+    __table_args__ = (db.Index('ix_users_twitter_profile_image_pending', 'id', postgresql_where=db.text("twitter_profile_image_pending_url IS NOT NULL")),)
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     registered_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
@@ -74,7 +178,12 @@ class User(db.Model):
     nym = db.Column(db.String(32), unique=True, nullable=True, index=True)
 
     twitter_username = db.Column(db.String(32), unique=True, nullable=True, index=True)
+    twitter_user_id = db.Column(db.String(32), nullable=True) # saved when the username is set, so we don't have to look it up every time we send a DM
     twitter_profile_image_url = db.Column(db.String(256), nullable=True)
+    twitter_profile_image_thumbnail_url = db.Column(db.String(256), nullable=True)
+    # the new profile picture (URL on Twitter), until ingest-media fetches the file and uploads it to S3 (see set_twitter_profile_image)
+    twitter_profile_image_pending_url = db.Column(db.String(256), nullable=True)
+    twitter_profile_image_fetch_attempts = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     twitter_username_verified = db.Column(db.Boolean, nullable=False, default=False)
     twitter_username_verification_tweet_id = db.Column(db.String(64), nullable=True)
 
@@ -88,23 +197,37 @@ class User(db.Model):
     bids = db.relationship('Bid', backref='buyer')
     messages = db.relationship('Message', backref='user')
 
-    def fetch_twitter_profile_image(self, s3):
-        url = fetch_image(self.twitter_profile_image_url, s3, f"user_{self.id}_twitter_profile_image")
-        if not url:
-            return False
-        self.twitter_profile_image_url = url
-        return True
+    @staticmethod
+    def get_cache_key(key):
+        return f"user_{key}"
+
+    def detached_copy(self):
+        user = User(**{c.key: getattr(self, c.key) for c in User.__table__.columns})
+        make_transient_to_detached(user)
+        return user
+
+    def set_twitter_profile_image(self, url):
+        """
+        Use a new profile picture from Twitter, which will be fetched (and uploaded to S3) in the background, by ingest-media.
+        """
+        from events import notify, MEDIA_EVENTS
+        if self.twitter_profile_image_url is None:
+            self.twitter_profile_image_url = url # until it is fetched, we can use the one on Twitter
+        self.twitter_profile_image_pending_url = url
+        self.twitter_profile_image_fetch_attempts = 0
+        notify(MEDIA_EVENTS)
 
     def to_dict(self):
         d = {
             'nym': self.nym,
             'twitter_username': self.twitter_username,
             'twitter_profile_image_url': self.twitter_profile_image_url,
+            'twitter_profile_image_thumbnail_url': self.twitter_profile_image_thumbnail_url or self.twitter_profile_image_url,
             'twitter_username_verified': self.twitter_username_verified,
             'twitter_username_verification_tweet': f"https://twitter.com/{app.config['TWITTER_USER']}/status/{self.twitter_username_verification_tweet_id}",
             'contribution_percent': self.contribution_percent,
-            'has_auctions': len(self.auctions) > 0,
-            'has_bids': len(self.bids) > 0}
+            'has_auctions': db.session.query(Auction.query.filter_by(seller_id=self.id).exists()).scalar(),
+            'has_bids': db.session.query(Bid.query.filter_by(buyer_id=self.id).exists()).scalar()}
         if self.is_moderator:
             d['is_moderator'] = True
         return d
@@ -241,6 +364,11 @@ class InternalNotificationAction(NotificationAction):
         return True
 
 class TwitterDMNotificationAction(NotificationAction):
+    def __init__(self):
+        # NB: execute() is called concurrently by process-notifications, so all the threads share this to stay within Twitter's limits
+        # (while each thread uses a Twitter session of its own, see get_twitter)
+        self.rate_limiter = TokenBucket(app.config['TWITTER_DM_RATE_LIMIT'], app.config['TWITTER_DM_RATE_LIMIT_BURST'])
+
     @property
     def action(self):
         return 'TWITTER_DM'
@@ -250,12 +378,28 @@ class TwitterDMNotificationAction(NotificationAction):
         return "Twitter DM"
 
     def execute(self, user, message):
-        from main import get_twitter
+        from main import get_twitter, TwitterError
         twitter = get_twitter()
-        twitter_user = twitter.get_user(user.twitter_username)
-        if not twitter_user:
-            return False
-        return twitter.send_dm(twitter_user['id'], message.body)
+        twitter_user_id = user.twitter_user_id
+        if not twitter_user_id:
+            twitter_user = twitter.get_user(user.twitter_username)
+            if not twitter_user:
+                return False
+            twitter_user_id = twitter_user['id']
+        for attempt in range(app.config['TWITTER_DM_RETRIES'] + 1):
+            self.rate_limiter.acquire()
+            try:
+                return twitter.send_dm(twitter_user_id, message.body)
+            except TwitterError as e:
+                if not e.transient or attempt == app.config['TWITTER_DM_RETRIES']:
+                    app.logger.error(f"Failed to send Twitter DM to {user.id=} ({attempt=} {e.status_code=}). Giving up.")
+                    return False
+                app.logger.warning(f"Failed to send Twitter DM to {user.id=} ({attempt=} {e.status_code=}). Retrying...")
+                if e.retry_after is not None:
+                    # NB: we hit Twitter's rate limit, so none of the threads should send anything until it resets
+                    self.rate_limiter.pause(e.retry_after)
+                else:
+                    time.sleep(app.config['TWITTER_DM_RETRY_BACKOFF'] * 2 ** attempt)
 
 NOTIFICATION_ACTIONS = OrderedDict([
     (na.action, na) for na in [IgnoreNotificationAction(), TwitterDMNotificationAction(), InternalNotificationAction()]
@@ -285,7 +429,12 @@ class Message(db.Model):
     __tablename__ = 'messages'
 
     # NB: this makes sure we never ever send the same notification to the same user twice!
-    __table_args__ = (db.UniqueConstraint('user_id', 'key'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'key'),
+        # NB: messages are paginated by (created_at, id) (see api.paginate), so these can be read from the index in order, page by page
+        db.Index('ix_messages_user_id_notified_via_created_at_id', 'user_id', 'notified_via', 'created_at', 'id'),
+        db.Index('ix_messages_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -295,7 +444,7 @@ class Message(db.Model):
     # for example, for an AUCTION_END notification, we would combine that to the auction ID.
     key = db.Column(db.String(64), nullable=False)
 
-    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     body = db.Column(db.String(512), nullable=True)
 
@@ -317,6 +466,15 @@ def hash_create(length):
 class Auction(db.Model):
     __tablename__ = 'auctions'
 
+    __table_args__ = (
+        db.Index('ix_auctions_seller_id_created_at', 'seller_id', 'created_at'),
+        # the two halves of the featured auctions query (see featured_auctions in api.py)
+        db.Index('ix_auctions_featured', 'id', postgresql_where=db.text("is_featured")),
+        db.Index('ix_auctions_featured_running', 'end_date', 'start_date', postgresql_where=db.text("is_featured IS NULL")),
+    )
+
+    FEATURED_CACHE_KEY = 'featured_auctions'
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     seller_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
@@ -336,7 +494,7 @@ class Auction(db.Model):
     # duration_hours reflects the initial duration,
     # but the auction can be extended when bids come in close to the end - hence the end_date
     duration_hours = db.Column(db.Float, nullable=False)
-    end_date = db.Column(db.DateTime, nullable=True)
+    end_date = db.Column(db.DateTime, nullable=True, index=True)
 
     starting_bid = db.Column(db.Integer, nullable=False)
     reserve_bid = db.Column(db.Integer, nullable=False)
@@ -356,6 +514,12 @@ class Auction(db.Model):
 
     winning_bid_id = db.Column(db.Integer, nullable=True)
 
+    # these are denormalized from the settled bids and maintained by settle-bids (see bid_settled),
+    # so we don't need to look at all the bids just to know which one is on top
+    top_bid_id = db.Column(db.Integer, nullable=True)
+    top_bid_amount = db.Column(db.Integer, nullable=True)
+    settled_bid_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     bids = db.relationship('Bid', backref='auction', foreign_keys='Bid.auction_id', order_by='desc(Bid.requested_at)')
@@ -372,16 +536,70 @@ class Auction(db.Model):
         return self.end_date < datetime.utcnow() if self.end_date else False
 
     def get_top_bid(self):
-        return max((bid for bid in self.bids if bid.settled_at), default=None, key=lambda bid: bid.amount)
+        # NB: this doesn't hit the database if the bids were already loaded
+        return db.session.get(Bid, self.top_bid_id) if self.top_bid_id is not None else None
+
+    def validate_bid(self, amount):
+        """
+        Check whether a new bid can be placed, raising ValidationError if not.
+        Only looks at the auction's own columns, so it works the same for the sync and the async (asgi.py) bids endpoints.
+        """
+        if not self.started or self.ended:
+            raise AuctionNotRunning()
+        if self.top_bid_amount is not None and amount <= self.top_bid_amount:
+            raise ValidationError(f"The top bid is currently {self.top_bid_amount}. Your bid needs to be higher!")
+        elif amount <= self.starting_bid:
+            raise ValidationError(f"Your bid needs to be higher than {self.starting_bid}, the starting bid.")
+
+    def bid_settled(self, bid):
+        # NB: the auction should be locked (SELECT ... FOR UPDATE) by the caller, so concurrent settlements don't overwrite each other's changes
+        self.settled_bid_count += 1
+        if self.top_bid_amount is None or bid.amount > self.top_bid_amount:
+            self.top_bid_id = bid.id
+            self.top_bid_amount = bid.amount
+
+    @classmethod
+    def bid_stats_query(cls):
+        """
+        Compute top_bid_id, top_bid_amount and settled_bid_count from scratch, looking at all the bids, for all auctions with settled bids.
+        Ties are won by the bid that settled first, just like with bid_settled.
+        """
+        # NB: this is done by the database, in one go, the same way as in the migration that introduced these columns
+        return db.session.query(
+                Bid.auction_id,
+                Bid.id.label('top_bid_id'),
+                Bid.amount.label('top_bid_amount'),
+                db.func.count().over(partition_by=Bid.auction_id).label('settled_bid_count')) \
+            .filter(Bid.settled_at != None) \
+            .distinct(Bid.auction_id) \
+            .order_by(Bid.auction_id, Bid.amount.desc(), Bid.settled_at, Bid.id) \
+            .subquery()
+
+    @classmethod
+    def query_with_related(cls):
+        # eager load everything that to_dict needs (seller, media, bids and their buyers),
+        # so that serializing any number of auctions takes a fixed number of queries
+        return cls.query.options(
+            joinedload(cls.seller),
+            selectinload(cls.media),
+            selectinload(cls.bids).joinedload(Bid.buyer))
+
+    @classmethod
+    def to_dict_list(cls, auctions, for_user=None):
+        # NB: the "following" flags for all the auctions are fetched in one query, rather than one query per auction in to_dict
+        following = {}
+        if for_user is not None and auctions:
+            following = {ua.auction_id: ua.following
+                for ua in UserAuction.query.filter(UserAuction.user_id == for_user, UserAuction.auction_id.in_([a.id for a in auctions]))}
+        return [a.to_dict(for_user=for_user, following=following.get(a.id, False)) for a in auctions]
 
     @property
     def reserve_bid_reached(self):
         if self.reserve_bid == 0:
             return True
-        top_bid = self.get_top_bid()
-        return top_bid.amount >= self.reserve_bid if top_bid else False
+        return self.top_bid_amount >= self.reserve_bid if self.top_bid_amount is not None else False
 
-    def to_dict(self, for_user=None):
+    def to_dict(self, for_user=None, following=None, qr_format=qr.SVG):
         auction = {
             'key': self.key,
             'title': self.title,
@@ -396,7 +614,7 @@ class Auction(db.Model):
             'reserve_bid_reached': self.reserve_bid_reached,
             'shipping_from': self.shipping_from,
             'bids': [bid.to_dict(for_user=for_user) for bid in self.bids if bid.settled_at],
-            'media': [{'url': media.url, 'twitter_media_key': media.twitter_media_key} for media in self.media],
+            'media': [media.to_dict() for media in self.media],
             'created_at': self.created_at.isoformat() + "Z",
             'is_mine': for_user == self.seller_id,
             'seller_twitter_username': self.seller.twitter_username,
@@ -408,9 +626,9 @@ class Auction(db.Model):
             auction['reserve_bid'] = self.reserve_bid
 
         if self.contribution_amount is not None:
-            top_bid = self.get_top_bid() # TODO: should this be based on the winning bid rather than the top bid *if* the contribution was already settled? in case the top bid somehow never becomes the winning bid?
+            # TODO: should this be based on the winning bid rather than the top bid *if* the contribution was already settled? in case the top bid somehow never becomes the winning bid?
             auction['contribution_amount'] = self.contribution_amount
-            auction['remaining_amount'] = top_bid.amount - self.contribution_amount
+            auction['remaining_amount'] = self.top_bid_amount - self.contribution_amount
 
         if self.winning_bid_id is not None:
             assert self.contribution_settled_at is not None # settle-bids should set both contribution_settled_at and winning_bid_id at the same time!
@@ -432,15 +650,15 @@ class Auction(db.Model):
                     auction['needs_contribution'] = True
                     auction['contribution_percent'] = self.seller.contribution_percent
                     auction['contribution_payment_request'] = self.contribution_payment_request
-                    qr = BytesIO()
-                    pyqrcode.create(self.contribution_payment_request).svg(qr, omithw=True, scale=4)
-                    auction['contribution_qr'] = qr.getvalue().decode('utf-8')
+                    auction['contribution_qr'] = qr.render(self.contribution_payment_request, qr_format)
                 elif for_user == self.seller_id:
                     auction['wait_contribution'] = True
 
         if for_user is not None:
-            user_auction = UserAuction.query.filter_by(user_id=for_user, auction_id=self.id).one_or_none()
-            auction['following'] = user_auction.following if user_auction is not None else False
+            if following is None:
+                user_auction = UserAuction.query.filter_by(user_id=for_user, auction_id=self.id).one_or_none()
+                following = user_auction.following if user_auction is not None else False
+            auction['following'] = following
         else:
             auction['following'] = False # TODO: when does this even happen?
 
@@ -530,27 +748,45 @@ class Auction(db.Model):
 class Media(db.Model):
     __tablename__ = 'media'
 
+    # NB: ingest-media looks for the media that still needs to be fetched
+    __table_args__ = (db.Index('ix_media_pending', 'id', postgresql_where=db.text("fetched_at IS NULL")),)
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    auction_id = db.Column(db.Integer, db.ForeignKey(Auction.id), nullable=False)
+    auction_id = db.Column(db.Integer, db.ForeignKey(Auction.id), nullable=False, index=True)
     twitter_media_key = db.Column(db.String(50), nullable=False)
+
+    # this is the original URL (on Twitter) until ingest-media fetches the file and uploads it to S3
     url = db.Column(db.String(256), nullable=False)
+    thumbnail_url = db.Column(db.String(256), nullable=True)
+    medium_url = db.Column(db.String(256), nullable=True)
+    fetched_at = db.Column(db.DateTime, nullable=True)
+    fetch_attempts = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
-    def fetch(self, s3, filename):
-        url = fetch_image(self.url, s3, filename)
-        if not url:
-            return False
-        self.url = url
-        return True
+    def to_dict(self):
+        # NB: the derivatives are missing until the media is fetched (or if the image could not be decoded), in which case we fall back to the original
+        return {
+            'url': self.url,
+            'thumbnail_url': self.thumbnail_url or self.url,
+            'medium_url': self.medium_url or self.url,
+            'twitter_media_key': self.twitter_media_key,
+        }
 
 class Bid(db.Model):
     __tablename__ = 'bids'
 
+    __table_args__ = (
+        db.Index('ix_bids_auction_id_settled_at', 'auction_id', 'settled_at'),
+        # NB: the settled bids of an auction are paginated by (requested_at, id) (see api.get_bids)
+        db.Index('ix_bids_settled_auction_id_requested_at_id', 'auction_id', 'requested_at', 'id', postgresql_where=db.text("settled_at IS NOT NULL")),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     auction_id = db.Column(db.Integer, db.ForeignKey(Auction.id), nullable=False)
-    buyer_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+    buyer_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False, index=True)
 
     requested_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     settled_at = db.Column(db.DateTime) # a bid is settled after the Lightning invoice has been paid
+    rejected_at = db.Column(db.DateTime) # the invoice was paid too late for the bid to count (see settle_invoices), so the deposit needs to be refunded
 
     amount = db.Column(db.Integer, nullable=False)
 
@@ -572,7 +808,68 @@ class Bid(db.Model):
 class UserAuction(db.Model):
     __tablename__ = 'user_auctions'
 
+    # NB: the primary key is (user_id, auction_id), which doesn't help when looking up the followers of an auction
+    __table_args__ = (db.Index('ix_user_auctions_auction_id_following', 'auction_id', 'following'),)
+
     user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False, primary_key=True)
     auction_id = db.Column(db.Integer, db.ForeignKey(Auction.id), nullable=False, primary_key=True)
 
     following = db.Column(db.Boolean, nullable=False)
+
+class NotificationEvent(db.Model):
+    __tablename__ = 'notification_events'
+
+    # Events that might trigger notifications are added to this table (the "outbox") in the same transaction as the change they refer to,
+    # so process-notifications can pick them up (and delete them) after being woken up by a NOTIFY.
+    BID_SETTLED = 'BID_SETTLED'
+    END_DATE_CHANGED = 'END_DATE_CHANGED'
+
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    event_type = db.Column(db.String(32), nullable=False)
+
+    auction_id = db.Column(db.Integer, db.ForeignKey(Auction.id, ondelete='CASCADE'), nullable=False)
+    bid_id = db.Column(db.Integer, db.ForeignKey(Bid.id, ondelete='CASCADE'), nullable=True)
+
+    auction = db.relationship('Auction')
+    bid = db.relationship('Bid')
+
+    @classmethod
+    def enqueue(cls, event_type, auction, bid=None):
+        from events import notify, NOTIFICATION_EVENTS
+        db.session.add(cls(event_type=event_type, auction=auction, bid=bid))
+        notify(NOTIFICATION_EVENTS)
+
+class DepositInvoice(db.Model):
+    __tablename__ = 'deposit_invoices'
+
+    # Since all bids require the same (small) deposit, invoices for it are created in advance by refill-deposit-invoices
+    # and each new bid takes one out of this table, so LND is not involved in placing a bid at all.
+
+    id = db.Column(db.Integer, primary_key=True)
+    payment_request = db.Column(db.String(512), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def claim_query(cls):
+        # NB: the invoice needs to stay valid for as long as a bid invoice normally would,
+        # and with SKIP LOCKED concurrent bids never wait for each other, but simply get different invoices
+        return db.select(cls) \
+            .filter(cls.expires_at > datetime.utcnow() + timedelta(seconds=app.config['LND_BID_INVOICE_EXPIRY'])) \
+            .order_by(cls.expires_at) \
+            .limit(1) \
+            .with_for_update(skip_locked=True)
+
+    @classmethod
+    def claim(cls):
+        """
+        Take an invoice out of the pool, as part of the current transaction. Returns None if the pool is empty.
+        """
+        from events import notify, DEPOSIT_INVOICE_EVENTS
+        invoice = db.session.execute(cls.claim_query()).scalars().first()
+        if invoice is not None:
+            db.session.delete(invoice)
+            notify(DEPOSIT_INVOICE_EVENTS)
+        return invoice
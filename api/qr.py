@@ -0,0 +1,41 @@
+from functools import lru_cache
+from io import BytesIO
+
+import pyqrcode
+
+SVG = 'svg'
+MATRIX = 'matrix' # rows of "0" and "1" (one character per module), to be drawn by the client
+FORMATS = [SVG, MATRIX]
+
+CACHE_SIZE = 1024
+
+def _render(data, format):
+    code = pyqrcode.create(data)
+    if format == MATRIX:
+        return ["".join(str(module) for module in row) for row in code.code]
+    else:
+        qr = BytesIO()
+        code.svg(qr, omithw=True, scale=4)
+        return qr.getvalue().decode('utf-8')
+
+def _render_in_pool(data, format):
+    from main import get_qr_pool
+    pool = get_qr_pool()
+    if pool is None:
+        return _render(data, format)
+    else:
+        # NB: the encoding is pure Python, so rendering it in another process avoids holding the GIL while other requests wait
+        return pool.submit(_render, data, format).result()
+
+_render_cached = lru_cache(maxsize=CACHE_SIZE)(_render_in_pool)
+
+def render(data, format=SVG, cache=True):
+    """
+    Render a QR code for the given data in one of the FORMATS.
+    Results are cached, since the same payment requests get rendered over and over (on every poll of an auction, for example),
+    but one-off codes (such as login ones) should not be, so they don't push the others out of the cache.
+    """
+    if cache:
+        return _render_cached(data, format)
+    else:
+        return _render_in_pool(data, format)
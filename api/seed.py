@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+import csv
+import io
+import random
+
+from sqlalchemy import func
+
+from extensions import db
+from main import app
+import models as m
+
+# NB: rows are generated and COPY'd in chunks, so we never hold all of them in memory
+CHUNK_SIZE = 100_000
+
+def copy(cursor, table, columns, rows):
+    """
+    Bulk insert the rows (an iterable of tuples) using COPY, which is much faster than INSERT for large amounts of data.
+    """
+    count = 0
+    while True:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        chunk_count = 0
+        for row in rows:
+            writer.writerow(["\\N" if v is None else v for v in row])
+            chunk_count += 1
+            if chunk_count == CHUNK_SIZE:
+                break
+        if chunk_count == 0:
+            break
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+        count += chunk_count
+        app.logger.info(f"Copied {count} rows into {table}...")
+        if chunk_count < CHUNK_SIZE:
+            break
+    return count
+
+def next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+def seed(user_count, auction_count, bid_count, follow_count, message_count):
+    """
+    Generate a lot of (realistic looking) data, for testing how the API behaves with large tables.
+    Everything is generated on top of whatever is already in the database.
+    """
+    now = datetime.utcnow()
+    first_user_id, first_auction_id, first_bid_id = next_id(m.User), next_id(m.Auction), next_id(m.Bid)
+    user_ids = range(first_user_id, first_user_id + user_count)
+    auction_ids = range(first_auction_id, first_auction_id + auction_count)
+
+    # most auctions ended in the past, some are running and a few did not start yet
+    auctions = {}
+    for auction_id in auction_ids:
+        duration_hours = random.choice([1, 24, 48, 72, 24 * 7])
+        start_date = now + timedelta(hours=random.uniform(-24 * 60, 24)) if random.random() < 0.95 else None
+        auctions[auction_id] = {
+            'seller_id': random.choice(user_ids),
+            'start_date': start_date,
+            'duration_hours': duration_hours,
+            'end_date': start_date + timedelta(hours=duration_hours) if start_date else None,
+            'starting_bid': random.choice([0, 1000, 10000]),
+            'reserve_bid': random.choice([0, 0, 50000, 100000]),
+        }
+    started_auction_ids = [auction_id for auction_id, a in auctions.items() if a['start_date'] and a['start_date'] < now]
+
+    # a few auctions get most of the bids
+    bids_per_auction = random.choices(started_auction_ids, weights=[random.paretovariate(1.5) for _ in started_auction_ids], k=bid_count) if started_auction_ids else []
+    bids_per_auction.sort()
+
+    raw_connection = db.engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+
+        copy(cursor, 'users', ['id', 'registered_at', 'key', 'twitter_username', 'twitter_username_verified', 'twitter_profile_image_url', 'contribution_percent'],
+            ((user_id, now - timedelta(days=random.uniform(0, 365)), f"seed_key_{user_id}", f"seed_user_{user_id}", random.random() < 0.8,
+              f"https://api.lorem.space/image/face?hash={user_id}", random.choice([1, 2, 5])) for user_id in user_ids))
+
+        def generate_bids():
+            bid_id = first_bid_id
+            previous_auction_id, amount = None, 0
+            for auction_id in bids_per_auction:
+                a = auctions[auction_id]
+                if auction_id != previous_auction_id:
+                    previous_auction_id, amount = auction_id, a['starting_bid']
+                amount += random.randint(1, 10) * 1000
+                requested_at = min(a['start_date'] + timedelta(hours=random.uniform(0, a['duration_hours'])), now)
+                settled_at = requested_at + timedelta(seconds=random.uniform(1, 60)) if random.random() < 0.9 else None
+                yield (bid_id, auction_id, random.choice(user_ids), requested_at, settled_at, amount, f"MOCK_SEED_{bid_id}")
+                bid_id += 1
+
+        copy(cursor, 'auctions', ['id', 'seller_id', 'key', 'title', 'description', 'start_date', 'duration_hours', 'end_date', 'starting_bid', 'reserve_bid', 'created_at'],
+            ((auction_id, a['seller_id'], f"S{auction_id:x}", f"Seeded auction #{auction_id}", "Lorem ipsum dolor sit amet. " * random.randint(1, 20),
+              a['start_date'], a['duration_hours'], a['end_date'], a['starting_bid'], a['reserve_bid'], (a['start_date'] or now) - timedelta(hours=random.uniform(0, 48)))
+                for auction_id, a in auctions.items()))
+
+        copy(cursor, 'bids', ['id', 'auction_id', 'buyer_id', 'requested_at', 'settled_at', 'amount', 'payment_request'], generate_bids())
+
+        # the denormalized bid stats are computed the same way as in the migration that introduced them (see also Auction.bid_stats_query)
+        cursor.execute("""
+            UPDATE auctions SET top_bid_id = top_bids.id, top_bid_amount = top_bids.amount, settled_bid_count = top_bids.count
+            FROM (
+                SELECT DISTINCT ON (auction_id) auction_id, id, amount, count(*) OVER (PARTITION BY auction_id) AS count FROM bids
+                WHERE settled_at IS NOT NULL AND auction_id >= %s
+                ORDER BY auction_id, amount DESC, settled_at, id
+            ) AS top_bids
+            WHERE top_bids.auction_id = auctions.id
+        """, (first_auction_id,))
+
+        follows = {(random.choice(user_ids), random.choice(auction_ids)) for _ in range(follow_count)}
+        copy(cursor, 'user_auctions', ['user_id', 'auction_id', 'following'],
+            ((user_id, auction_id, random.random() < 0.9) for user_id, auction_id in follows))
+
+        copy(cursor, 'messages', ['user_id', 'key', 'created_at', 'body', 'notified_via'],
+            ((random.choice(user_ids), f"SEED_{i}", now - timedelta(minutes=random.uniform(0, 60 * 24 * 60)), f"Seeded message #{i}", random.choice(['INTERNAL', 'TWITTER_DM', None]))
+                for i in range(message_count)))
+
+        # since we used explicit IDs, the sequences need to catch up
+        for table in ['users', 'auctions', 'bids']:
+            cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))")
+        cursor.execute("ANALYZE")
+
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
@@ -0,0 +1,42 @@
+from datetime import timedelta
+import heapq
+
+class AuctionEndTimers:
+    """
+    Min-heap of the moments when auctions enter their last 10 minutes and when they end.
+    Rescheduling an auction (when its end date changes) doesn't remove its old entries from the heap,
+    they are simply skipped once they come up (lazy deletion), since we always know the current end date of each auction.
+    """
+
+    WARNING_BEFORE_END = timedelta(minutes=10)
+
+    def __init__(self):
+        self.heap = []
+        self.end_dates = {}
+
+    def schedule(self, auction_id, end_date):
+        if end_date is None:
+            self.end_dates.pop(auction_id, None)
+            return
+        if self.end_dates.get(auction_id) == end_date:
+            return
+        self.end_dates[auction_id] = end_date
+        heapq.heappush(self.heap, (end_date - AuctionEndTimers.WARNING_BEFORE_END, auction_id, end_date))
+        heapq.heappush(self.heap, (end_date, auction_id, end_date))
+
+    def next_at(self):
+        while self.heap and self.end_dates.get(self.heap[0][1]) != self.heap[0][2]:
+            heapq.heappop(self.heap) # stale entry
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """
+        Return the IDs of all auctions that had a timer fire by now.
+        """
+        due = set()
+        while (at := self.next_at()) is not None and at <= now:
+            _, auction_id, end_date = heapq.heappop(self.heap)
+            due.add(auction_id)
+            if end_date <= now:
+                del self.end_dates[auction_id] # the auction ended, so both its timers fired
+        return due
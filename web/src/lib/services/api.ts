@@ -23,15 +23,19 @@ export class ErrorHandler {
     }
 }
 
-function fetchAPI(path, method, tokenValue, json, checkResponse) {
-    var API_BASE;
+function getApiBase(isAsync = false) {
     if (isLocal()) {
-        API_BASE = "http://localhost:5000/api";
+        // NB: in production nginx routes the requests to the async API (see api/asgi.py), but locally it runs on a separate port
+        return isAsync ? "http://localhost:5001/api" : "http://localhost:5000/api";
     } else if (isStaging()) {
-        API_BASE = "https://staging.plebeian.market/api";
+        return "https://staging.plebeian.market/api";
     } else {
-        API_BASE = "https://plebeian.market/api";
+        return "https://plebeian.market/api";
     }
+}
+
+function fetchAPI(path, method, tokenValue, json, checkResponse) {
+    var API_BASE = getApiBase();
 
     var headers = {};
     if (tokenValue) {
@@ -163,12 +167,13 @@ export function putVerifyTwitter(tokenValue, successCB: () => void, errorHandler
         });
 }
 
-export function getAuctions(tokenValue, successCB: (auctions: Auction[]) => void, errorHandler = new ErrorHandler()) {
-    fetchAPI("/auctions", 'GET', tokenValue, null,
+export function getAuctions(tokenValue, successCB: (auctions: Auction[], nextCursor: string | null) => void, errorHandler = new ErrorHandler(), cursor: string | null = null) {
+    // the API returns the auctions one page at a time (newest first) and nextCursor can be used to get the next page (null if this was the last one)
+    fetchAPI("/auctions" + (cursor ? `?cursor=${encodeURIComponent(cursor)}` : ""), 'GET', tokenValue, null,
         response => {
             if (response.status === 200) {
                 response.json().then(data => {
-                    successCB(data.auctions.map(auctionFromJson));
+                    successCB(data.auctions.map(auctionFromJson), data.next_cursor);
                 });
             } else {
                 errorHandler.handle(response);
@@ -187,6 +192,16 @@ export function getAuction(tokenValue, auctionKey, successCB: (Auction) => void,
         });
 }
 
+export function subscribeAuctionEvents(auctionKey, eventCB: (event: string) => void) {
+    // NB: clients should GET the auction whenever the stream (re)connects, since events might have been missed while disconnected
+    var eventSource = new EventSource(`${getApiBase(true)}/auctions/${auctionKey}/events`);
+    eventSource.onopen = () => eventCB('open');
+    for (const event of ['bid', 'end_date', 'winner', 'contribution', 'resync']) {
+        eventSource.addEventListener(event, () => eventCB(event));
+    }
+    return eventSource;
+}
+
 export function putAuction(tokenValue, auction: Auction, successCB: () => void, errorHandler = new ErrorHandler()) {
     fetchAPI(`/auctions/${auction.key}`, 'PUT', tokenValue, auction.toJson(),
         response => {